@@ -1,10 +1,13 @@
 
 from .bigplot import BigPlot
+from .climatology import SpectralClimatology
+from .compaction import ResultsCompactor
 from .keplot import plot_ke_relerr
 from .nvar import NVARDataset
 from .plot_metrics import MetricsPlot
 from .rc import RCDataset
+from .rechunk import SQGRechunker
 from .single_time_plot import SingleTimePlot
-from .sqgturbgenerator import SQGTurbGenerator
+from .sqgturbgenerator import SQGTurbGenerator, SQGTurbEnsemble
 from .utils import global_legend, concatenate_time
 from .xsqgturb import XSQGTurb
@@ -0,0 +1,196 @@
+import os
+
+import numpy as np
+import xarray as xr
+
+from .xsqgturb import XSQGTurb
+
+def merge_moments(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """Combine count, mean and sum of squared deviations from two sets of
+    samples, the pairwise version of Welford's algorithm (Chan et al., 1979)
+
+    Returns:
+        n, mean, m2: for the union of both sets
+    """
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta**2 * n_a * n_b / n
+    return n, mean, m2
+
+
+def log_histogram(values, edges):
+    """Count the rows of values (n, m) in log spaced bins, separately for each
+    of the m columns. Bin 0 holds everything below edges[0], including zeros,
+    and values above edges[-1] go in the last bin.
+
+    Args:
+        values (np.ndarray): with shape (n, m)
+        edges (np.ndarray): increasing, positive bin edges
+
+    Returns:
+        counts (np.ndarray): with shape (m, len(edges)), to be summed over blocks
+    """
+    n_bins = len(edges)
+    index = np.searchsorted(edges, values, side="right").clip(max=n_bins-1)
+    column = np.arange(values.shape[1])[None, :]
+    counts = np.bincount((column*n_bins + index).ravel(), minlength=values.shape[1]*n_bins)
+    return counts.reshape(values.shape[1], n_bins)
+
+
+def histogram_quantiles(counts, edges, quantiles):
+    """Quantiles of each row of counts from :func:`log_histogram`, interpolated
+    log linearly within the bin that holds them. Quantiles in bin 0 are 0.
+
+    Returns:
+        values (np.ndarray): with shape (len(quantiles), m)
+    """
+    cdf = np.cumsum(counts, axis=1)
+    n = cdf[:, -1:]
+    values = []
+    for q in quantiles:
+        rank = q * (n - 1)
+        index = np.argmax(cdf > rank, axis=1)[:, None]
+        before = np.take_along_axis(cdf, index, axis=1) - np.take_along_axis(counts, index, axis=1)
+        fraction = (rank - before + 0.5) / np.take_along_axis(counts, index, axis=1)
+        lower = np.log10(edges[(index-1).clip(min=0)])
+        upper = np.log10(edges[index])
+        value = np.where(index > 0, 10**(lower + fraction.clip(0, 1)*(upper - lower)), 0.)
+        values.append(value[:, 0])
+    return np.stack(values)
+
+
+class SpectralClimatology():
+    """Stream through a long trajectory one block of time at a time, and
+    accumulate the climatological statistics used to normalize the validation
+    metrics, so that they never need the whole trajectory in memory.
+
+    Note:
+        The per wavenumber quantiles are estimated from a histogram of the 1D KE
+        density in log spaced bins, accumulated over blocks, so their memory is
+        fixed (k1d x bins, about 1 MB for N=64) rather than growing with n_time.
+        Within the range of ke_decades, they are accurate to within one bin,
+        a factor 10**(1/bins_per_decade), i.e. 2% with the defaults.
+
+    Note:
+        Each block is read and transformed in float32, and only the moments are
+        accumulated in float64. The default block_size keeps the block and the
+        kernel's temporaries (about 8 copies of the block) within max_mem. Reads are
+        cheapest from a store with the whole field in each chunk, e.g. from
+        :class:`SQGRechunker`, since each block then reads only the chunks it needs.
+
+    Example:
+        >>> sc = SpectralClimatology(zstore="sqg.theta.0300dt.064n.100kt.02z.02y.02x.field.01step.zarr")
+        >>> clim = sc()
+    """
+
+    zstore      = None
+    output      = None              # defaults to zstore with .climatology.zarr suffix
+    field_name  = "theta"
+    block_size  = None              # time steps per block, defaults to fit in max_mem
+    max_mem     = 2**30             # bytes used by each block, including the kernel's temporaries
+    quantiles   = (0.05, 0.25, 0.5, 0.75, 0.95)
+    ke_decades  = (-20, 10)         # range of log10 KE density resolved by the quantile histogram
+    bins_per_decade = 100
+    xsqg        = None              # defaults to XSQGTurb.from_dataset on the store
+
+    def __init__(self, **kwargs):
+        for key, val in kwargs.items():
+            try:
+                getattr(self, key)
+            except:
+                raise
+            setattr(self, key, val)
+
+        if self.output is None:
+            self.output = os.path.splitext(self.zstore.rstrip("/"))[0] + ".climatology.zarr"
+
+
+    def __call__(self):
+
+        xds = xr.open_zarr(self.zstore)
+        self.xsqg = XSQGTurb.from_dataset(xds) if self.xsqg is None else self.xsqg
+
+        theta = xds[self.field_name].transpose("time", "z", "y", "x")
+        block_size = self.default_block_size(theta) if self.block_size is None else self.block_size
+
+        n_z = len(theta["z"])
+        level = (0, np.zeros(n_z), np.zeros(n_z))
+        total = (0, 0., 0.)
+        spectrum = (0, 0., 0.)
+        edges = self.histogram_edges()
+        counts = 0
+
+        for start in range(0, len(theta["time"]), block_size):
+            block = theta.isel(time=slice(start, start+block_size)).values.astype(np.float32, copy=False)
+            n_block = block.shape[0]
+
+            # field moments, per level and for the whole field
+            per_level = block.swapaxes(0, 1).reshape(n_z, -1)
+            mean = per_level.mean(axis=1, dtype=np.float64)
+            m2 = np.square(per_level - mean.astype(np.float32)[:, None]).sum(axis=1, dtype=np.float64)
+            level = merge_moments(*level, per_level.shape[1], mean, m2)
+            del per_level
+
+            mean = block.mean(dtype=np.float64)
+            m2 = np.square(block - np.float32(mean)).sum(dtype=np.float64)
+            total = merge_moments(*total, block.size, mean, m2)
+
+            # KE spectrum moments
+            kespec = self.xsqg.kespec1d_array(block)
+            mean = kespec.mean(axis=0, dtype=np.float64)
+            spectrum = merge_moments(*spectrum, n_block, mean, ((kespec - mean)**2).sum(axis=0))
+            counts = counts + log_histogram(kespec, edges)
+
+        xds = self.to_dataset(theta, level, total, spectrum, histogram_quantiles(counts, edges, self.quantiles))
+        xds.to_zarr(self.output, mode="w", consolidated=True)
+        return xds
+
+
+    def default_block_size(self, theta):
+        """Time steps per block that fit in max_mem, rounded down to a multiple
+        of the store's time chunk when it is larger than one chunk"""
+        snapshot_bytes = 8 * np.dtype(np.float32).itemsize * len(theta["z"]) * len(theta["y"]) * len(theta["x"])
+        block_size = max(1, int(self.max_mem // snapshot_bytes))
+        time_chunk = theta.data.chunksize[0]
+        if block_size >= time_chunk:
+            block_size = block_size // time_chunk * time_chunk
+        return block_size
+
+
+    def histogram_edges(self):
+        """Log spaced edges of the KE density histogram used for the quantiles"""
+        start, stop = self.ke_decades
+        return np.logspace(start, stop, (stop - start)*self.bins_per_decade + 1)
+
+
+    def to_dataset(self, theta, level, total, spectrum, ke_quantile):
+
+        k1d = self.xsqg._k1d(dimensional_wavenumbers=True)
+        quantile = xr.DataArray(list(self.quantiles), coords={"quantile": list(self.quantiles)}, dims="quantile")
+        xds = xr.Dataset(coords={"k1d": k1d, "z": theta["z"], "quantile": quantile})
+
+        n, mean, m2 = spectrum
+        xds["ke_mean"] = xr.DataArray(mean, coords={"k1d": k1d}, dims="k1d",
+                                      attrs={"description": "time mean of the 1D KE density"})
+        xds["ke_std"] = xr.DataArray(np.sqrt(m2/n), coords={"k1d": k1d}, dims="k1d",
+                                     attrs={"description": "standard deviation in time of the 1D KE density"})
+        xds["ke_quantile"] = xr.DataArray(ke_quantile,
+                                          coords={"quantile": quantile, "k1d": k1d},
+                                          dims=("quantile", "k1d"),
+                                          attrs={"description": "quantiles in time of the 1D KE density"})
+
+        n, mean, m2 = level
+        xds[f"{self.field_name}_mean"] = xr.DataArray(mean, coords={"z": theta["z"]}, dims="z",
+                                                      attrs={"description": f"mean of {self.field_name} on each level"})
+        xds[f"{self.field_name}_std"] = xr.DataArray(np.sqrt(m2/n), coords={"z": theta["z"]}, dims="z",
+                                                     attrs={"description": f"standard deviation of {self.field_name} on each level"})
+
+        n, mean, m2 = total
+        xds[f"{self.field_name}_std_total"] = xr.DataArray(np.sqrt(m2/n),
+                                                           attrs={"description": f"standard deviation of {self.field_name} over (time, z, y, x)"})
+
+        xds.attrs = {"source": self.zstore,
+                     "field_name": self.field_name,
+                     "n_time": len(theta["time"])}
+        return xds
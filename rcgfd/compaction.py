@@ -0,0 +1,87 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from .io import open_store, stack_datasets
+
+class ResultsCompactor():
+    """Merge the per sample results.000.zarr, results.001.zarr, ... stores of
+    each validation directory into a single results.zarr with a sample
+    dimension and consolidated metadata, so that later opens are one metadata
+    read. The default chunks are contiguous in (z, y, x) and split over sample,
+    so that the metric reductions stream a few large chunks per sample.
+
+    Note:
+        The merged store is written next to the per sample stores, which are
+        only removed if remove_samples=True. Since RCDataset and NVARDataset
+        look for results.zarr first, they pick up the merged store automatically.
+
+    Example:
+        >>> rcd = RCDataset(n_sub=[1, 4, 16], cost_terms=[{"nrmse": 1, "spectral": 1e-1}])
+        >>> ResultsCompactor(dataset=rcd)()
+    """
+
+    dataset         = None          # RCDataset or NVARDataset, defines the paths via get_results_path
+    chunks          = None          # defaults to {"sample": 1, "time": -1, "z": -1, "y": -1, "x": -1}
+    overwrite       = False         # if False, skip directories that already have results.zarr
+    remove_samples  = False         # if True, delete the per sample stores after merging
+    max_workers     = 16
+
+    def __init__(self, **kwargs):
+        for key, val in kwargs.items():
+            try:
+                getattr(self, key)
+            except:
+                raise
+            setattr(self, key, val)
+
+        if self.chunks is None:
+            self.chunks = {"sample": 1, "time": -1, "z": -1, "y": -1, "x": -1}
+
+
+    def __call__(self):
+        """Compact every experiment in the dataset's grid
+
+        Returns:
+            fnames (list of str): paths to the merged stores
+        """
+        return [self.compact(*args) for args in self.dataset.experiments()]
+
+
+    def compact(self, *args):
+        """Merge the per sample stores for a single experiment
+
+        Args:
+            args: passed to the dataset's get_results_path,
+                e.g. (cost, n_sub) for RCDataset or (n_lag, n_sub) for NVARDataset
+
+        Returns:
+            fname (str): path to the merged store
+        """
+
+        _, fname = self.dataset.get_results_path(*args)
+        if os.path.isdir(fname) and not self.overwrite:
+            print(f"ResultsCompactor.compact: {fname} exists, skipping")
+            return fname
+
+        paths = [fname.replace("results", f"results.{i:03d}") for i in range(self.dataset.n_samples)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            dslist = list(executor.map(lambda path: open_store(path, chunks={}), paths))
+
+        xds = stack_datasets(dslist, dim="sample")
+        xds = xds.chunk({key: val for key, val in self.chunks.items() if key in xds.dims})
+        for key in xds.variables:
+            xds[key].encoding = {}
+
+        # write to a temporary store first, so an interrupted write is never
+        # mistaken for a complete results.zarr
+        tmp = fname.rstrip("/") + ".tmp"
+        xds.to_zarr(tmp, mode="w", consolidated=True)
+        if os.path.isdir(fname):
+            shutil.rmtree(fname)
+        os.rename(tmp, fname)
+
+        if self.remove_samples:
+            for path in paths:
+                shutil.rmtree(path)
+        return fname
@@ -1,8 +1,146 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
 import numpy as np
 import xarray as xr
+import dask.array as darray
 
 from ddc import YAMLParser
-from sqgtools import XSQGTurb
+
+from .metrics import METRICS
+from .xsqgturb import XSQGTurb
+
+def _forecast_sums(forecast, truth):
+    """Sums over the trailing (z, y, x) axes of forecast**2, forecast*truth,
+    and (forecast-truth)**2, for one block"""
+    axes = (-3, -2, -1)
+    # a forecast that is constant in time, like persistence, has a length 1
+    # time axis here, so its norm is only computed once
+    forecast_sq = (forecast**2).sum(axes)
+    forecast, truth = np.broadcast_arrays(forecast, truth)
+    return np.stack([
+        np.broadcast_to(forecast_sq, truth.shape[:-3]),
+        (forecast*truth).sum(axes),
+        ((forecast-truth)**2).sum(axes)],
+        axis=-1)
+
+
+def _truth_sums(truth):
+    """Sums over the trailing (z, y, x) axes of truth and truth**2, for one block"""
+    axes = (-3, -2, -1)
+    return np.stack([truth.sum(axes), (truth**2).sum(axes)], axis=-1)
+
+
+def spatial_sums(kernel, terms, *args, dims=("z", "y", "x")):
+    """Apply a kernel that computes several spatial sums at once, blockwise
+    over every other dimension, so that each block is read once and no full
+    size intermediates are kept
+
+    Args:
+        kernel (callable): taking numpy arrays with dims as the trailing axes,
+            returning an array with the sums stacked along the last axis
+        terms (list of str): names of the sums, in the kernel's order
+        args (xarray.DataArray): inputs to the kernel, rechunked to be
+            contiguous in dims if dask backed
+        dims (tuple of str, optional): dimensions to sum over
+
+    Returns:
+        sums (dict): of xarray.DataArray, one per term
+    """
+
+    args = [a.chunk({d: -1 for d in dims}) if a.chunks is not None else a for a in args]
+    sums = xr.apply_ufunc(
+            kernel,
+            *args,
+            input_core_dims=[list(dims)]*len(args),
+            output_core_dims=[["term"]],
+            dask="parallelized",
+            output_dtypes=[args[0].dtype],
+            dask_gufunc_kwargs={"output_sizes": {"term": len(terms)}})
+    return {key: sums.isel(term=i) for i, key in enumerate(terms)}
+
+
+@lru_cache(maxsize=None)
+def _read_config(path, mtime):
+    return YAMLParser().read(path)
+
+
+def read_config(path):
+    """Read and parse a yaml config, cached per path until the file is modified,
+    so that experiments sharing a directory or config are only parsed once.
+
+    Note:
+        The returned dict is shared between calls, don't modify it
+    """
+    return _read_config(path, os.path.getmtime(path))
+
+
+def open_store(path, chunks=None):
+    """Open a zarr store, reading the consolidated metadata if it exists.
+    For zarr v2 stores this is known from the .zmetadata file, otherwise let
+    xarray look for it in the store's metadata"""
+    consolidated = True if os.path.exists(os.path.join(path, ".zmetadata")) else None
+    return xr.open_zarr(path, chunks=chunks, consolidated=consolidated)
+
+
+def store_mtime(path):
+    """Latest modification time of the metadata files of a zarr store, at the
+    top level and for each array. Rewriting or appending to a store updates
+    these, whereas the mtime of the store's directory itself does not change"""
+    names = (".zmetadata", ".zgroup", ".zarray", ".zattrs", "zarr.json")
+    dirs = [path] + [entry.path for entry in os.scandir(path) if entry.is_dir()]
+    mtimes = [os.path.getmtime(os.path.join(d, name)) for d in dirs for name in names
+              if os.path.exists(os.path.join(d, name))]
+    return max(mtimes, default=os.path.getmtime(path))
+
+
+def stack_datasets(dslist, dim="sample"):
+    """Combine datasets with identical structure along a new or existing
+    dimension, like xr.concat(dslist, dim=dim, coords="minimal") but without
+    aligning or comparing the variables of every dataset. Only the indexes and
+    the coordinates without dim, which are taken from the first dataset, are
+    checked for consistency, and the data are stacked lazily.
+
+    Args:
+        dslist (list of xarray.Dataset): to combine
+        dim (str, optional): dimension to combine along
+
+    Returns:
+        xds (xarray.Dataset): combined dataset
+    """
+
+    first = dslist[0]
+    for xds in dslist[1:]:
+        for key, index in first.indexes.items():
+            if key != dim and not index.equals(xds.indexes[key]):
+                raise ValueError(f"stack_datasets: index {key} differs between datasets, use xr.concat")
+        for key, val in first.coords.items():
+            if key != dim and key not in first.indexes and dim not in val.dims and not val.equals(xds[key]):
+                raise ValueError(f"stack_datasets: coordinate {key} differs between datasets, use xr.concat")
+
+    def combine(key, arrays):
+        dims = first[key].dims
+        if dim in dims:
+            return dims, darray.concatenate(arrays, axis=dims.index(dim))
+        else:
+            return (dim,)+dims, darray.stack(arrays, axis=0)
+
+    data_vars = {}
+    for key, val in first.data_vars.items():
+        data_vars[key] = combine(key, [xds[key].data for xds in dslist]) + (val.attrs,)
+
+    coords = {}
+    for key, val in first.coords.items():
+        if dim in val.dims:
+            coords[key] = xr.concat([xds[key] for xds in dslist], dim=dim)
+        else:
+            coords[key] = val
+
+    return xr.Dataset(data_vars, coords=coords, attrs=first.attrs)
+
 
 class Dataset():
 
@@ -13,6 +151,12 @@ class Dataset():
     dims        = ("n_sub",)
     time        = np.arange(0, 12*3600+1, 4800)
     include_persist = True
+    climatology = None          # path to a SpectralClimatology store, used to normalize nrmse and ke_nrmse
+    metrics_only = False        # if True, skip the gridded error fields, use calc_error_fields if needed later
+    metrics     = ("rmse", "nrmse", "acc", "ke_rel_err", "ke_rmse", "ke_nrmse")   # any registered in rcgfd.metrics.METRICS
+    inputs      = ("sums", "truth_std", "kespec", "ke_std")
+    cache_dir   = None          # if set, reduced metrics are cached here, see get_cache_path
+    max_workers = 16            # threads used to open the per sample results stores
 
     squeeze     = True
 
@@ -28,7 +172,18 @@ class Dataset():
         self.n_sub = (self.n_sub,) if not isinstance(self.n_sub, (list, tuple)) else self.n_sub
 
 
-    def postprocess_dataset(self, xds):
+    def postprocess_dataset(self, xds, fnames=None):
+        """Compute all metrics, or read them from the cache, computing only
+        those that are missing from it
+
+        Args:
+            xds (xarray.Dataset): with truth and prediction
+            fnames (list of str, optional): the results.zarr paths xds was opened
+                from, used to read and write the metrics cache if :attr:`cache_dir` is set
+
+        Returns:
+            xds (xarray.Dataset): with metrics added
+        """
 
         if self.squeeze:
             xds = xds.squeeze()
@@ -38,73 +193,272 @@ class Dataset():
         for key in self.dims:
             if key in xds["truth"].dims:
                 xds["truth"] = xds["truth"].isel({key: 0})
+        xds = self.scale_truth(xds)
 
+        if self.include_persist:
+            xds["persistence"] = xds["truth"].isel(time=0)
 
-        xds = self.calc_metrics(xds)
-        xds = self.calc_spectral_metrics(xds)
+        if self.cache_dir is None or fnames is None:
+            return self.calc_metrics(xds)
 
-        # Persistence error
-        xds["persistence"] = xds["truth"].isel(time=0)
-        pds = self.calc_metrics(xds[["truth","persistence"]], pkey="persistence")
-        pds = self.calc_spectral_metrics(pds, pkey="persistence")
-        for key in ["rmse", "nrmse", "acc", "ke_rel_err", "ke_rmse", "ke_nrmse"]:
-            xds[f"p_{key}"] = pds[key]
-        return xds
+        # only compute the metrics that aren't cached yet, and add them to the cache
+        cache_path = self.get_cache_path(fnames)
+        cached = xr.open_zarr(cache_path) if os.path.isdir(cache_path) else xr.Dataset()
+        missing = [name for name in self.metrics if name not in cached]
+        if len(missing) > 0:
+            xds = self.calc_metrics(xds, metrics=missing)
+            keys = [key for name in missing for key in (name, f"p_{name}") if key in xds]
+            mode = "a" if os.path.isdir(cache_path) else "w"
+            xds[keys].to_zarr(cache_path, mode=mode, consolidated=True)
+            # return what was just written rather than computing the metrics again
+            xds = xds.drop_vars(keys)
+            cached = xr.open_zarr(cache_path)
+
+        # calc_metrics adds these when not metrics_only, so do the same when everything is cached
+        elif not self.metrics_only:
+            xds = self.calc_error_fields(xds)
+
+        keys = [key for name in self.metrics for key in (name, f"p_{name}") if key in cached]
+        return xds.merge(cached[keys], compat="override")
+
+
+    def get_cache_path(self, fnames):
+        """Path to the cached metrics computed from the stores in fnames, with
+        settings that change the metrics. Since the modification time of each
+        store's metadata (see :func:`store_mtime`) and the content of its
+        config-lazy.yaml are in the key, along with that of the climatology store
+        if any, changing any of them points to a new cache entry. The requested metrics are not, so that one entry accumulates
+        metrics as more are requested.
+
+        Args:
+            fnames (list of str): the results.zarr paths
+
+        Returns:
+            cache_path (str): to a zarr store in :attr:`cache_dir`
+        """
+
+        sources = []
+        for fname in fnames:
+            stores = [fname] if os.path.isdir(fname) else \
+                     [fname.replace("results", f"results.{i:03d}") for i in range(self.n_samples)]
+
+            config = fname.replace("results.zarr", "config-lazy.yaml")
+            if os.path.isfile(config):
+                with open(config, "rb") as f:
+                    config_hash = hashlib.sha256(f.read()).hexdigest()
+            else:
+                config_hash = None
+
+            sources.append({
+                "path": fname,
+                "mtime": max(store_mtime(s) for s in stores if os.path.exists(s)),
+                "config": config_hash,
+            })
+
+        key = {
+            "sources": sources,
+            "time": [float(t) for t in self.time],
+            "dims": list(self.dims),
+            "squeeze": self.squeeze,
+            "include_persist": self.include_persist,
+            "climatology": self.climatology,
+            "climatology_mtime": None if self.climatology is None else store_mtime(self.climatology),
+        }
+        key = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"metrics.{key[:16]}.zarr")
+
+
+    def open_experiments(self, dim):
+        """Open, renormalize and expand every experiment concurrently, then
+        combine them into a single dataset
+
+        Args:
+            dim (str): the dimension along which experiments with the same n_sub differ
+
+        Returns:
+            xds (xarray.Dataset): with dimensions ("n_sub", dim, ...)
+            fnames (list of str): the results.zarr path for each experiment
+        """
+
+        experiments = self.experiments()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            dslist = list(executor.map(lambda args: self.open_single_dataset(*args), experiments))
+        fnames = [self.get_results_path(*args)[1] for args in experiments]
+
+        n_experiments = len(dslist) // len(self.n_sub)
+        grid = [dslist[i:i+n_experiments] for i in range(0, len(dslist), n_experiments)]
+        xds = xr.combine_nested(grid, concat_dim=["n_sub", dim])
+        return xds, fnames
+
+
+    def open_results(self, fname):
+        """Open results.zarr, or if it doesn't exist, the per sample stores
+        results.000.zarr, results.001.zarr, ... concurrently, and stack them
+        along the sample dimension
+
+        Args:
+            fname (str): path to results.zarr
+
+        Returns:
+            xds (xarray.Dataset): with all samples
+        """
+
+        if os.path.isdir(fname):
+            return open_store(fname, chunks=self.chunks)
+
+        paths = [fname.replace("results", f"results.{i:03d}") for i in range(self.n_samples)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            dslist = list(executor.map(lambda path: open_store(path, chunks=self.chunks), paths))
+        return stack_datasets(dslist, dim="sample")
 
 
     def renormalize_dataset(self, xds, fname):
+        """Undo the normalization used by the model, given by norm_factor in
+        the config-lazy.yaml next to fname, if any
 
-        yp = YAMLParser()
-        c = yp.read(fname.replace("results.zarr", "config-lazy.yaml"))
-        if "preprocessing" in c:
-            sd = c["preprocessing"].pop("norm_factor", None)
+        Note:
+            Only prediction is scaled here. The factor is stored as
+            truth_norm_factor and applied by :meth:`scale_truth` once the
+            single copy of truth that is kept has been selected, rather than
+            to every experiment's copy of truth.
+        """
+
+        c = read_config(fname.replace("results.zarr", "config-lazy.yaml"))
+        sd = c.get("preprocessing", {}).get("norm_factor", None)
 
         if sd is not None:
             with xr.set_options(keep_attrs=True):
-                for key in ["truth", "prediction"]:
-                    xds[key] = xds[key]*sd
+                xds["prediction"] = xds["prediction"]*sd
+            xds["truth_norm_factor"] = sd
         return xds
 
 
-    def calc_metrics(self, xds, pkey="prediction"):
+    def scale_truth(self, xds):
+        """Apply the norm factor recorded by :meth:`renormalize_dataset` to truth,
+        using the factor of the same experiment that truth was selected from"""
+
+        if "truth_norm_factor" in xds:
+            sd = xds["truth_norm_factor"].fillna(1.)
+            for key in self.dims:
+                if key in sd.dims:
+                    sd = sd.isel({key: 0})
+
+            # the factor is stored in float64, don't let it promote single precision truth
+            sd = sd.astype(xds["truth"].dtype)
+            with xr.set_options(keep_attrs=True):
+                xds["truth"] = xds["truth"]*sd
+            xds = xds.drop_vars("truth_norm_factor")
+        return xds
 
+
+    def open_climatology(self):
+        """Read the (small) climatological statistics computed by :class:`SpectralClimatology`"""
+        return xr.open_zarr(self.climatology).load()
+
+
+    def calc_error_fields(self, xds, pkey="prediction"):
+        """Add the gridded error and absolute_error of xds[pkey] relative to truth,
+        which are not needed by any of the metrics, see :attr:`metrics_only`
+        """
         xds["error"] = xds[pkey] - xds["truth"]
         xds["absolute_error"] = np.abs(xds["error"])
+        return xds
 
-        dims = ["x","y","z"]
-        xds["rmse"] = np.sqrt( (xds["error"]**2).mean(dims) )
-        xds["rmse"].attrs = {
-            "label": "RMSE",
-        }
-        xds["nrmse"] = xds["rmse"] / xds["truth"].std(dims+["time"])
-        xds["nrmse"].attrs = {
-            "label": "NRMSE",
-        }
 
-        # ACC / Cosine Similarity
-        norm = {key: np.sqrt( (xds[key]**2).sum(dims) ) for key in [pkey, "truth"]}
-        numerator = (xds[pkey] * xds["truth"]).sum(dims)
-        denominator = norm[pkey]*norm["truth"]
-        xds["acc"] =  numerator / denominator
-        xds["acc"].attrs = {
-            "description" : "Anomaly Correlation Coefficient, equivalent to Cosine Similarity since climatology is 0.",
-            "label": "ACC",
-        }
-        return xds
+    def calc_metrics(self, xds, pkey="prediction", metrics=None):
+        """Compute the requested metrics of xds[pkey] relative to truth, and if
+        xds has a "persistence" forecast, the same metrics for it with a p_ prefix
 
+        Note:
+            Each metric declares the intermediate inputs it needs, see
+            :func:`rcgfd.metrics.register_metric`, and only those are computed.
+            For instance, asking for nrmse alone needs the spatial sums but no FFTs.
 
-    def calc_spectral_metrics(self, xds, pkey="prediction"):
+        Args:
+            xds (xarray.Dataset): with truth and xds[pkey]
+            pkey (str, optional): name of the forecast
+            metrics (list of str, optional): names of registered metrics,
+                defaults to :attr:`metrics`
 
-        xsqg = XSQGTurb()
+        Returns:
+            xds (xarray.Dataset): with metrics added
+        """
 
-        # Get dataset with common time
-        kds = xds.sel(time=self.time, method="nearest")
-        ktrue = xsqg.calc_kespec1d(kds["truth"].load())
-        kpred = xsqg.calc_kespec1d(kds[pkey].load())
+        metrics = self.metrics if metrics is None else metrics
+        if not self.metrics_only:
+            xds = self.calc_error_fields(xds, pkey=pkey)
 
-        kerr = kpred - ktrue
-        xds["ke_rel_err"] = kerr / np.abs(ktrue)
-        xds["ke_rmse"] = np.sqrt( (kerr**2).mean("k1d") )
-        xds["ke_nrmse"] = np.sqrt( ((kerr/ktrue.std("time"))**2).mean("k1d") )
+        forecasts = {"": pkey}
+        if "persistence" in xds and pkey != "persistence":
+            forecasts["p_"] = "persistence"
 
+        inputs = {}
+        for name in metrics:
+            metric = METRICS[name]
+            for requirement in metric["requires"]:
+                self.calc_input(xds, requirement, forecasts, inputs)
+
+            for prefix, key in forecasts.items():
+                xds[f"{prefix}{name}"] = metric["func"](inputs, key)
+                xds[f"{prefix}{name}"].attrs = metric["attrs"].copy()
         return xds
+
+
+    def calc_input(self, xds, name, forecasts, inputs):
+        """Compute an intermediate input used by the metrics, and the inputs
+        it depends on, unless they are already in inputs
+
+        Note:
+            All spatial sums are computed by one kernel per block of each
+            forecast, and one per block of truth, see :func:`spatial_sums`.
+            The truth KE spectrum is shared by all forecasts, and since
+            persistence has no time dimension its spectrum is only computed
+            once per sample.
+
+        Args:
+            xds (xarray.Dataset): with truth and the forecasts
+            name (str): "sums", "truth_std", "kespec", or "ke_std"
+            forecasts (dict): mapping metric prefix to forecast name
+            inputs (dict): computed inputs, updated in place
+        """
+
+        if name in inputs:
+            return
+
+        if name == "sums":
+            dims = ["z","y","x"]
+            sums = spatial_sums(_truth_sums, ["truth", "truth_sq"], xds["truth"], dims=dims)
+            for key in forecasts.values():
+                sums.update(spatial_sums(_forecast_sums,
+                                         [f"{key}_sq", f"{key}_cross", f"{key}_sq_error"],
+                                         xds[key], xds["truth"],
+                                         dims=dims))
+            sums["n_space"] = int(np.prod([xds.sizes[d] for d in dims]))
+            inputs[name] = sums
+
+        elif name == "truth_std":
+            # std of truth over space and time, from the spatial sums
+            if self.climatology is None:
+                self.calc_input(xds, "sums", forecasts, inputs)
+                sums = inputs["sums"]
+                count = (sums["truth"].notnull().sum("time") * sums["n_space"]).astype(sums["truth"].dtype)
+                mean = sums["truth"].sum("time") / count
+                inputs[name] = np.sqrt( sums["truth_sq"].sum("time") / count - mean**2 )
+            else:
+                inputs[name] = self.open_climatology()["theta_std_total"]
+
+        elif name == "kespec":
+            # Get dataset with common time, spectra are computed lazily blockwise
+            kds = xds.sel(time=self.time, method="nearest")
+            xsqg = XSQGTurb.from_dataset(kds)
+            inputs[name] = {key: xsqg.calc_kespec1d(kds[key]) for key in ["truth"] + list(forecasts.values())}
+
+        elif name == "ke_std":
+            if self.climatology is None:
+                self.calc_input(xds, "kespec", forecasts, inputs)
+                inputs[name] = inputs["kespec"]["truth"].std("time")
+            else:
+                inputs[name] = self.open_climatology()["ke_std"]
+
+        else:
+            raise ValueError(f"Dataset.calc_input: unrecognized input {name}, metrics can require {self.inputs}")
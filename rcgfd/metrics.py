@@ -0,0 +1,64 @@
+import numpy as np
+
+METRICS = {}
+
+def register_metric(name, requires, attrs=None):
+    """Decorator adding a metric to :data:`METRICS`, so that it can be
+    requested by name via Dataset.metrics
+
+    Args:
+        name (str): of the metric, and the variable it is stored as
+        requires (tuple of str): the intermediate inputs the metric uses, which
+            are computed by Dataset.calc_input only if some requested metric needs them,
+            "sums": spatial sums of truth and each forecast, see :func:`rcgfd.io.spatial_sums`,
+            "truth_std": std of truth over space and time, or from the climatology,
+            "kespec": 1D KE spectra of truth and each forecast at Dataset.time,
+            "ke_std": std in time of the truth KE spectrum, or from the climatology
+        attrs (dict, optional): attributes of the metric's DataArray
+
+    Example:
+        >>> @register_metric("mse", requires=("sums",), attrs={"label": "MSE"})
+        ... def mse(inputs, key):
+        ...     return inputs["sums"][f"{key}_sq_error"] / inputs["sums"]["n_space"]
+    """
+    def decorator(func):
+        METRICS[name] = {"func": func, "requires": tuple(requires), "attrs": {} if attrs is None else attrs}
+        return func
+    return decorator
+
+
+@register_metric("rmse", requires=("sums",), attrs={"label": "RMSE"})
+def rmse(inputs, key):
+    sums = inputs["sums"]
+    return np.sqrt( sums[f"{key}_sq_error"] / sums["n_space"] )
+
+
+@register_metric("nrmse", requires=("sums", "truth_std"), attrs={"label": "NRMSE"})
+def nrmse(inputs, key):
+    return rmse(inputs, key) / inputs["truth_std"]
+
+
+@register_metric("acc", requires=("sums",),
+                 attrs={"description" : "Anomaly Correlation Coefficient, equivalent to Cosine Similarity since climatology is 0.",
+                        "label": "ACC"})
+def acc(inputs, key):
+    sums = inputs["sums"]
+    return sums[f"{key}_cross"] / np.sqrt( sums[f"{key}_sq"] * sums["truth_sq"] )
+
+
+@register_metric("ke_rel_err", requires=("kespec",))
+def ke_rel_err(inputs, key):
+    kespec = inputs["kespec"]
+    return (kespec[key] - kespec["truth"]) / np.abs(kespec["truth"])
+
+
+@register_metric("ke_rmse", requires=("kespec",))
+def ke_rmse(inputs, key):
+    kespec = inputs["kespec"]
+    return np.sqrt( ((kespec[key] - kespec["truth"])**2).mean("k1d") )
+
+
+@register_metric("ke_nrmse", requires=("kespec", "ke_std"))
+def ke_nrmse(inputs, key):
+    kespec = inputs["kespec"]
+    return np.sqrt( (((kespec[key] - kespec["truth"])/inputs["ke_std"])**2).mean("k1d") )
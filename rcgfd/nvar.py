@@ -1,7 +1,3 @@
-import numpy as np
-import xarray as xr
-
-from ddc import YAMLParser
 from .io import Dataset
 
 class NVARDataset(Dataset):
@@ -15,24 +11,23 @@ class NVARDataset(Dataset):
     def __init__(self, **kwargs):
 
         self.n_lag = kwargs.pop("n_lag", None)
-        self.n_lag = (self.n_lag) if not isinstance(self.n_lag, (list, tuple)) else self.n_lag
+        self.n_lag = (self.n_lag,) if not isinstance(self.n_lag, (list, tuple)) else self.n_lag
         super().__init__(**kwargs)
 
 
     def __call__(self):
 
-        dslist=[]
-        for n_sub in self.n_sub:
-            dslist2 = []
-            for n_lag in self.n_lag:
-                dslist2.append( self.open_single_dataset(n_lag, n_sub) )
-            dslist.append(xr.concat(dslist2, dim='n_lag'))
-        xds = xr.concat(dslist, dim='n_sub')
+        xds, fnames = self.open_experiments(dim="n_lag")
 
-        xds = self.postprocess_dataset(xds)
+        xds = self.postprocess_dataset(xds, fnames=fnames)
         return xds
 
 
+    def experiments(self):
+        """The (n_lag, n_sub) arguments to get_results_path for every experiment"""
+        return [(n_lag, n_sub) for n_sub in self.n_sub for n_lag in self.n_lag]
+
+
     def get_results_path(self, n_lag, n_sub):
 
         dt0 = 300
@@ -47,13 +42,7 @@ class NVARDataset(Dataset):
 
         main_dir, fname = self.get_results_path(n_lag, n_sub)
 
-        try:
-            xds = xr.open_zarr(fname, chunks=self.chunks)
-        except:
-            xds = xr.concat(
-                    [xr.open_zarr(fname.replace("results", f"results.{i:03d}"), chunks=self.chunks) for i in range(self.n_samples)],
-                    dim="sample",
-                    coords="minimal")
+        xds = self.open_results(fname)
 
         xds = xds.expand_dims({
             'n_sub': [n_sub],
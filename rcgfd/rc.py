@@ -1,6 +1,3 @@
-import numpy as np
-import xarray as xr
-
 from .io import Dataset
 
 class RCDataset(Dataset):
@@ -23,18 +20,16 @@ class RCDataset(Dataset):
 
     def __call__(self):
 
-        dslist=[]
-        for n_sub in self.n_sub:
-            dslist2 = []
-            for ct in self.cost_terms:
-                dslist2.append( self.open_single_dataset(ct, n_sub) )
-            dslist.append(xr.concat(dslist2, dim='experiment'))
-
-        xds = xr.concat(dslist, dim='n_sub')
-        xds = self.postprocess_dataset(xds)
+        xds, fnames = self.open_experiments(dim="experiment")
+        xds = self.postprocess_dataset(xds, fnames=fnames)
         return xds
 
 
+    def experiments(self):
+        """The (cost, n_sub) arguments to get_results_path for every experiment"""
+        return [(ct, n_sub) for n_sub in self.n_sub for ct in self.cost_terms]
+
+
     def expand_dims(self, xds, main_dir, n_sub):
         experiment = main_dir.replace("cost-","").replace("old-", "").replace(f"{self.n_overlap:02d}overlap-","").replace(f"{self.n_reservoir//1000}kNr-","")
         xds = xds.expand_dims({
@@ -78,13 +73,7 @@ class RCDataset(Dataset):
 
         main_dir, fname = self.get_results_path(this_cost, n_sub)
 
-        try:
-            xds = xr.open_zarr(fname, chunks=self.chunks)
-        except:
-            xds = xr.concat(
-                    [xr.open_zarr(fname.replace("results", f"results.{i:03d}"), chunks=self.chunks) for i in range(self.n_samples)],
-                    dim="sample",
-                    coords="minimal")
+        xds = self.open_results(fname)
 
         xds = self.renormalize_dataset(xds, fname)
         xds = self.expand_dims(xds, main_dir, n_sub)
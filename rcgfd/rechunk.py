@@ -0,0 +1,201 @@
+import os
+import shutil
+
+import numpy as np
+import xarray as xr
+import dask.array as darray
+import zarr
+
+from .utils import concatenate_time
+
+class SQGRechunker():
+    """Copy a generated SQG store, chunked in small spatial tiles and long time
+    chunks for local patch RC training, into layouts with the whole field in
+    each chunk, for spectral diagnostics, optionally keeping only every step-th
+    time for subsampled time access. Memory is bounded by max_mem, in the
+    style of rechunker, with an intermediate store:
+
+    1. the source is read one time chunk by one band of x at a time, so every
+       source chunk is read exactly once, subsampled in time for each layout,
+       and written to an intermediate store chunked in time like the target
+       but still banded in x
+    2. the intermediate store is read one target time chunk at a time, which
+       is the whole field, and written to the target
+
+    With match_source_chunks=True, the layouts are instead chunked by chunksize,
+    which defaults to the chunks of the reference store, giving subsampled
+    training stores that read like it, and the source is copied directly in
+    one stage. This holds whether the source is the reference store or the
+    SQGTurbGenerator output, which is chunked differently in time.
+
+    Note:
+        An output that resolves to one of the source stores raises a ValueError
+        rather than overwriting it, e.g. step 1 with match_source_chunks=True and
+        the default output.
+
+    Example:
+        >>> rc = SQGRechunker(zstore="sqg.theta.0300dt.064n.100kt.02z.02y.02x.zarr", steps=(1, 4, 16, 48))
+        >>> paths = rc()
+
+        Subsampled training stores, e.g. sqg.theta.1200dt.064n.100kt.02z.02y.02x.zarr,
+        directly from the SQGTurbGenerator output
+
+        >>> rc = SQGRechunker(zstore=[f"sqg.{i}.064n.005years.02z.02y.02x.zarr" for i in range(5)],
+        ...                   output="sqg.theta.0300dt.064n.100kt.02z.02y.02x.zarr",
+        ...                   steps=(2, 4, 8, 16, 48),
+        ...                   match_source_chunks=True)
+        >>> paths = rc()
+    """
+
+    zstore          = None              # or a list of consecutive SQGTurbGenerator stores, see concatenate_time
+    output          = None              # names the target stores, defaults to zstore
+    field_name      = "theta"
+    steps           = (1,)              # temporal subsampling step of each layout
+    target_chunk_mb = 4                 # size of each target chunk, sets the time chunk size
+    max_mem         = 2**30             # bytes used by each source or intermediate block read
+    tmp_dir         = None              # for the intermediate stores, defaults to next to the output
+    match_source_chunks = False         # if True, use chunksize rather than whole field chunks
+    chunksize       = {"time": 103_680, "z": 2, "y": 2, "x": 2}    # of the reference training store
+
+    def __init__(self, **kwargs):
+        for key, val in kwargs.items():
+            try:
+                getattr(self, key)
+            except:
+                raise
+            setattr(self, key, val)
+
+        if self.output is None:
+            if not isinstance(self.zstore, str):
+                raise ValueError("SQGRechunker.__init__: output must be given when zstore is a list of stores")
+            self.output = self.zstore
+        self.tmp_dir = os.path.dirname(os.path.abspath(self.output)) if self.tmp_dir is None else self.tmp_dir
+
+
+    def __call__(self):
+        """Write every layout
+
+        Returns:
+            paths (dict): mapping step to the path of each target store
+        """
+
+        xds = self.open_source()
+        xda = xds[self.field_name].transpose("time", "z", "y", "x")
+
+        sources = [self.zstore] if isinstance(self.zstore, str) else self.zstore
+        sources = [os.path.abspath(path.rstrip("/")) for path in sources]
+        paths = {step: self.output_path(step, xds.attrs.get("delta_t", None)) for step in self.steps}
+        for step, path in paths.items():
+            if os.path.abspath(path) in sources:
+                raise ValueError(f"SQGRechunker.__call__: the output for step {step}, {path}, is the source store")
+
+        intermediates = {}
+        for step in self.steps:
+            if self.match_source_chunks:
+                intermediates[step] = paths[step]
+                sub = self.subsample(xda, step)
+                chunks = tuple(min(self.chunksize[d], len(sub[d])) for d in sub.dims)
+                self.create_store(paths[step], sub, xds.attrs, chunks=chunks)
+            else:
+                intermediates[step] = os.path.join(self.tmp_dir, os.path.basename(paths[step]) + ".tmp")
+                for path, x_chunk in zip([intermediates[step], paths[step]], [self.band_width(xda), len(xda["x"])]):
+                    sub = self.subsample(xda, step)
+                    chunks = (self.time_chunk(sub), len(xda["z"]), len(xda["y"]), x_chunk)
+                    self.create_store(path, sub, xds.attrs, chunks=chunks)
+
+        # stage 1: source -> intermediate, reading each source chunk once
+        source_steps = xda.chunks[0][0]
+        band = self.band_width(xda)
+        for start in range(0, len(xda["time"]), source_steps):
+            for x_start in range(0, len(xda["x"]), band):
+                x_slice = slice(x_start, x_start+band)
+                block = xda.isel(time=slice(start, start+source_steps), x=x_slice).values
+
+                for step in self.steps:
+                    # global time indices that are multiples of step
+                    first = (-start) % step
+                    if first >= block.shape[0]:
+                        continue
+
+                    t_start = (start + first) // step
+                    data = block[first::step]
+                    self.write_region(intermediates[step], data,
+                                      time=slice(t_start, t_start+data.shape[0]), x=x_slice)
+
+        if self.match_source_chunks:
+            return paths
+
+        # stage 2: intermediate -> target, one whole field time chunk at a time
+        for step in self.steps:
+            inter = xr.open_zarr(intermediates[step])[self.field_name]
+            time_steps = self.time_chunk(xda)
+            for start in range(0, len(inter["time"]), time_steps):
+                t_slice = slice(start, start+time_steps)
+                data = inter.isel(time=t_slice).values
+                self.write_region(paths[step], data, time=t_slice, x=slice(None))
+
+            shutil.rmtree(intermediates[step])
+
+        return paths
+
+
+    def open_source(self):
+        if isinstance(self.zstore, str):
+            return xr.open_zarr(self.zstore)
+        else:
+            return concatenate_time([xr.open_zarr(path)[[self.field_name]] for path in self.zstore])
+
+
+    def output_path(self, step, delta_t=None):
+        """For whole field layouts, the output with a .field.<step>step.zarr suffix.
+        With match_source_chunks, the output with its time step label, e.g. 0300dt,
+        replaced by the subsampled one, or with a .<step>step.zarr suffix if it has none"""
+
+        stem = os.path.splitext(self.output.rstrip("/"))[0]
+        label = None if delta_t is None else f"{int(delta_t):04d}dt"
+        if self.match_source_chunks and label is not None and label in stem:
+            return stem.replace(label, f"{int(delta_t)*step:04d}dt") + ".zarr"
+        elif self.match_source_chunks:
+            return stem + f".{step:02d}step.zarr"
+        else:
+            return stem + f".field.{step:02d}step.zarr"
+
+
+    def time_chunk(self, xda):
+        """Number of time steps with the whole field in target_chunk_mb"""
+        field_bytes = xda.dtype.itemsize * np.prod([len(xda[d]) for d in ["z", "y", "x"]])
+        return max(1, int(self.target_chunk_mb * 2**20 // field_bytes))
+
+
+    def band_width(self, xda):
+        """Width in x of the bands read from the source, the largest multiple
+        of the source x chunk that fits in max_mem"""
+        x_chunk = xda.chunks[-1][0]
+        column_bytes = xda.dtype.itemsize * xda.chunks[0][0] * len(xda["z"]) * len(xda["y"])
+        n_chunks = max(1, int(self.max_mem // (column_bytes * x_chunk)))
+        return min(len(xda["x"]), n_chunks * x_chunk)
+
+
+    @staticmethod
+    def subsample(xda, step):
+        xda = xda.isel(time=slice(None, None, step))
+        xda.attrs = xda.attrs.copy()
+        xda.attrs["temporal_subsampling_step"] = step
+        return xda
+
+
+    def create_store(self, path, xda, attrs, chunks):
+        """Write the metadata and coordinates for a layout, without data"""
+
+        template = xda.copy(data=darray.zeros(xda.shape, chunks=chunks, dtype=xda.dtype))
+        template.encoding = {}
+        xds = template.to_dataset(name=self.field_name)
+        xds.attrs = attrs.copy()
+        if "delta_t" in xds.attrs:
+            xds.attrs["delta_t"] = xds.attrs["delta_t"] * xda.attrs["temporal_subsampling_step"]
+        xds.to_zarr(path, mode="w", compute=False)
+
+
+    def write_region(self, path, data, time, x):
+        array = zarr.open_array(path, path=self.field_name, mode="r+")
+        array[time, :, :, x] = data
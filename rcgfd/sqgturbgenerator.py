@@ -3,9 +3,12 @@ Note: Nice brief description of the model in 10.1175/MWR-D-20-0290.1
 """
 
 import os
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import redirect_stdout
+from time import perf_counter
 
 import numpy as np
+import dask.array as darray
 import matplotlib.pyplot as plt
 import xarray as xr
 import zarr
@@ -57,6 +60,9 @@ class SQGTurbGenerator():
     precision       = 'single'
     threads         = int(os.getenv('OMP_NUM_THREADS', '30'))
     logfile         = 'stdout.log'
+    block_steps     = None              # if set, integrate and store in blocks of this many steps, see stream_trajectory
+    restart         = True              # in streaming mode, resume from the checkpoint of zstore if it exists
+    member          = None              # index along the member dimension of zstore, see SQGTurbEnsemble
 
     @property
     def nbytes_spinup(self):
@@ -110,13 +116,30 @@ class SQGTurbGenerator():
 
         # Create and spinup
         dataobj = self.create_object()
+        n_stored = 0
 
-        if pickup_zstore is None:
+        if self.block_steps is not None and self.restart and os.path.isfile(self.checkpoint_file(self.zstore)):
+
+            self.localtime.start(f"Restarting from {self.checkpoint_file(self.zstore)}")
+            dataobj.x0, n_stored = self.read_checkpoint(self.zstore)
+            # with nothing stored yet, the first block overwrites whatever was written
+            if self.member is None and n_stored > 0:
+                self.truncate_store(n_stored+1)
+            self.localtime.stop()
+
+        elif pickup_zstore is None:
 
             self.localtime.start("Spinup")
             dataobj = self.spinup(dataobj)
             fig, ax = self.plot_pv(dataobj, cmap='plasma')
-            fig.savefig("spunup.jpg", bbox_inches='tight', dpi=300)
+            suffix = "" if self.member is None else f".member{self.member:03d}"
+            fig.savefig(f"spunup{suffix}.jpg", bbox_inches='tight', dpi=300)
+            self.localtime.stop()
+
+        elif os.path.isfile(self.checkpoint_file(pickup_zstore)):
+
+            self.localtime.start(f"Picking up from {self.checkpoint_file(pickup_zstore)}")
+            dataobj.x0, _ = self.read_checkpoint(pickup_zstore, set_rng=False)
             self.localtime.stop()
 
         else:
@@ -130,17 +153,28 @@ class SQGTurbGenerator():
             dataobj.x0 = x0
             self.localtime.stop()
 
-        self.localtime.start("Generating trajectory")
-        dataobj.generate(n_steps=self.trajectory_steps)
-        self.localtime.stop()
+        # checkpoint the spun up or picked up state, so a job stopped during the
+        # first block restarts from here rather than repeating the spinup
+        if self.block_steps is not None and n_stored == 0:
+            self.write_checkpoint(dataobj.x0, n_stored)
 
-        self.localtime.start("Converting to xarray")
-        xds = self.dataobj_to_xarray(dataobj)
-        self.localtime.stop()
+        if self.block_steps is None:
+            self.localtime.start("Generating trajectory")
+            dataobj.generate(n_steps=self.trajectory_steps)
+            self.localtime.stop()
+
+            self.localtime.start("Converting to xarray")
+            xds = self.dataobj_to_xarray(dataobj)
+            self.localtime.stop()
+
+            self.localtime.start("Chunking and storing")
+            self.xds_to_zarr(xds)
+            self.localtime.stop()
 
-        self.localtime.start("Chunking and storing")
-        self.xds_to_zarr(xds)
-        self.localtime.stop()
+        else:
+            self.localtime.start(f"Generating and storing trajectory in blocks of {self.block_steps} steps")
+            self.stream_trajectory(dataobj, n_stored=n_stored)
+            self.localtime.stop()
 
         self.walltime.stop("Total Walltime")
 
@@ -275,7 +309,7 @@ class SQGTurbGenerator():
         if np.array(ind).shape == ():
             return np.timedelta64(ind*self.delta_t, self.time_units)
         else:
-            return np.array([np.timedelta64(x*self.delta_t, self.time_units) for x in ind])
+            return (np.asarray(ind)*self.delta_t).astype(f'timedelta64[{self.time_units}]')
 
 
     def pv_to_theta(self, pv):
@@ -283,10 +317,27 @@ class SQGTurbGenerator():
 
 
     def dataobj_to_xarray(self, dataobj):
+        return self.values_to_xarray(dataobj.values)
+
+
+    def values_to_xarray(self, values, start=0):
+        """Inverse transform spectral states to a dataset with PV and theta
+
+        Args:
+            values (array_like): spectral states, with time as the last axis
+            start (int, optional): time index of the first state
+
+        Returns:
+            xds (xarray.Dataset): with q and theta
+        """
+
+        return self.array_to_xarray(self.map_1dtime_to_4d(values), start=start)
+
 
-        arr4d = self.map_1dtime_to_4d(dataobj.values)
+    def array_to_xarray(self, arr4d, start=0):
+        """Wrap PV on the grid, with dims (time, z, y, x), in a dataset with PV and theta"""
 
-        coords = {'time' : self.index_to_time(np.arange(arr4d.shape[0])),
+        coords = {'time' : self.index_to_time(start + np.arange(arr4d.shape[0])),
                   'z': self.z / 1000,
                   'y': self.y / 1000,
                   'x': self.x / 1000}
@@ -299,7 +350,6 @@ class SQGTurbGenerator():
                                   'description': 'potential vorticity'})
 
         xds = xds.to_dataset()
-        theta = arr4d * self.f
         xds['theta'] = xr.DataArray(self.pv_to_theta(arr4d),
                                     coords=coords,
                                     dims=dims,
@@ -340,3 +390,229 @@ class SQGTurbGenerator():
         store = zarr.NestedDirectoryStore(path=self.zstore)
         xds.to_zarr(store=store)
         self.print_log(f"saved to: {self.zstore}")
+
+
+    def stream_trajectory(self, dataobj, n_stored=0):
+        """Integrate the trajectory in blocks of :attr:`block_steps`, inverse
+        transforming and appending each block to the zarr store along time, so
+        that peak memory scales with the block rather than the whole trajectory.
+        After each block, the spectral state is checkpointed, see :meth:`write_checkpoint`.
+
+        Note:
+            Unless chunksize['time'] is set, the store is chunked in time by block_steps
+
+        Args:
+            dataobj (DataSQGturb): with the initial condition in x0
+            n_stored (int, optional): number of steps already in the store, when restarting
+        """
+
+        store = zarr.NestedDirectoryStore(path=self.zstore)
+
+        while n_stored < self.trajectory_steps:
+
+            n_steps = min(self.block_steps, self.trajectory_steps - n_stored)
+            dataobj.generate(n_steps=n_steps)
+
+            # after the first block, the initial condition was already stored
+            first = 0 if n_stored == 0 else 1
+            xds = self.values_to_xarray(dataobj.values[:, first:], start=n_stored+first)
+            self.append_to_zarr(xds, store, start=n_stored+first)
+
+            dataobj.x0 = dataobj.values[:, -1]
+            n_stored += n_steps
+            self.write_checkpoint(dataobj.x0, n_stored)
+            self.print_log(f"Stored {n_stored} / {self.trajectory_steps} steps")
+
+        self.print_log(f"saved to: {self.zstore}")
+
+
+    def checkpoint_file(self, zstore):
+        suffix = '' if self.member is None else f'.member{self.member:03d}'
+        return zstore.rstrip('/') + suffix + '.checkpoint.npz'
+
+
+    def write_checkpoint(self, x0, n_stored):
+        """Save the spectral state, the number of steps stored, and the state of
+        numpy's global random number generator. The file is a few hundred kB
+        and is replaced atomically, so it always matches the store.
+        It is also read by the next run when this store is its pickup_zstore.
+        """
+
+        fname = self.checkpoint_file(self.zstore)
+        name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        with open(fname + '.tmp', 'wb') as file:
+            np.savez(file,
+                     x0=x0,
+                     n_stored=n_stored,
+                     time=self.index_to_time(n_stored),
+                     rng_name=name,
+                     rng_keys=keys,
+                     rng_pos=pos,
+                     rng_has_gauss=has_gauss,
+                     rng_cached_gaussian=cached_gaussian)
+        os.replace(fname + '.tmp', fname)
+
+
+    def read_checkpoint(self, zstore, set_rng=True):
+        """Read the checkpoint written for zstore
+
+        Args:
+            zstore (str): path to the store that was being written
+            set_rng (bool, optional): if True, restore numpy's global random number generator
+
+        Returns:
+            x0 (array_like): spectral state
+            n_stored (int): number of steps stored in zstore, excluding the initial condition
+        """
+
+        with np.load(self.checkpoint_file(zstore)) as checkpoint:
+            if set_rng:
+                np.random.set_state((str(checkpoint['rng_name']),
+                                     checkpoint['rng_keys'],
+                                     int(checkpoint['rng_pos']),
+                                     int(checkpoint['rng_has_gauss']),
+                                     float(checkpoint['rng_cached_gaussian'])))
+            return checkpoint['x0'], int(checkpoint['n_stored'])
+
+
+    def truncate_store(self, n_time):
+        """Drop anything past the first n_time time steps of the store, which
+        may have been written after the last checkpoint before the job stopped"""
+
+        group = zarr.open_group(zarr.NestedDirectoryStore(path=self.zstore), mode='r+')
+        for _, array in group.arrays():
+            dims = array.attrs['_ARRAY_DIMENSIONS']
+            if 'time' in dims and array.shape[dims.index('time')] > n_time:
+                shape = list(array.shape)
+                shape[dims.index('time')] = n_time
+                array.resize(tuple(shape))
+        zarr.consolidate_metadata(group.store)
+
+
+    def append_to_zarr(self, xds, store, start):
+        """Write the first block of a trajectory, overwriting any partial store
+        left by a job stopped before its first checkpoint, or append one along time.
+        For an ensemble member, write the block to its region of the store
+        created by :meth:`SQGTurbEnsemble.create_store` instead."""
+
+        if self.member is not None:
+            xds = xds.expand_dims(member=[self.member]).drop_vars(['z', 'y', 'x'])
+            xds.to_zarr(store=store,
+                        region={'member': slice(self.member, self.member+1),
+                                'time': slice(start, start+len(xds['time']))})
+
+        elif start > 0:
+            xds.to_zarr(store=store, append_dim='time', safe_chunks=False)
+
+        else:
+            encoding = {key: {'chunks': tuple(self.zarr_chunks[d] for d in xds[key].dims)} for key in xds.data_vars}
+            xds.to_zarr(store=store, encoding=encoding, mode='w')
+
+
+    @property
+    def zarr_chunks(self):
+        """Chunk sizes of the stored trajectory, in time defaulting to block_steps"""
+        chunksize = self.chunksize.copy()
+        chunksize['time'] = self.block_steps if chunksize['time'] is None else chunksize['time']
+        chunksize['member'] = 1
+        return chunksize
+
+
+def _run_member(zstore, kwargs):
+    SQGTurbGenerator(zstore, **kwargs)()
+
+
+class SQGTurbEnsemble():
+    """Generate independent trajectories, differing by pv0_random_seed, in a
+    pool of processes, and store them in one zarr store with a member dimension
+
+    Note:
+        Each member streams its trajectory in blocks to its own region of the
+        store, with its own checkpoint, so that rerunning an interrupted
+        ensemble resumes every member. Parallelism within a member is only
+        via the FFT threads, so n_workers * threads should match the cores available.
+
+    Example:
+        >>> ens = SQGTurbEnsemble("sqg.ensemble.zarr", n_members=8, n_workers=4,
+        ...                       Nx=64, delta_t=300, threads=2, block_steps=8_640)
+        >>> ens()
+    """
+
+    n_members       = 4
+    n_workers       = None              # number of processes, defaults to n_members
+
+    def __init__(self, zstore, **kwargs):
+
+        self.zstore = zstore
+        for key in ['n_members', 'n_workers']:
+            if key in kwargs:
+                setattr(self, key, kwargs.pop(key))
+        self.n_workers = self.n_members if self.n_workers is None else self.n_workers
+
+        # everything else is passed to SQGTurbGenerator
+        self.kwargs = kwargs
+        self.generator = SQGTurbGenerator(zstore, **kwargs)
+        if self.generator.block_steps is None:
+            self.generator.block_steps = self.generator.trajectory_steps
+            self.kwargs['block_steps'] = self.generator.trajectory_steps
+
+
+    def __call__(self):
+        """Run all members
+
+        Returns:
+            rate (float): simulated member days per wall clock hour
+        """
+
+        if not os.path.isdir(self.zstore):
+            self.create_store()
+
+        start = perf_counter()
+        with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = [executor.submit(_run_member, self.zstore, self.member_kwargs(member))
+                       for member in range(self.n_members)]
+            for future in futures:
+                future.result()
+        walltime = perf_counter() - start
+
+        member_days = self.n_members * self.generator.trajectory_time / 86400
+        rate = member_days / (walltime / 3600)
+        self.generator.print_log(f"{self.n_members} members with {self.n_workers} processes, "
+                                 f"{self.generator.threads} threads each: "
+                                 f"{rate:.1f} member days / wall hour")
+        return rate
+
+
+    @property
+    def seeds(self):
+        return self.generator.pv0_random_seed + np.arange(self.n_members)
+
+
+    def member_kwargs(self, member):
+        kwargs = self.kwargs.copy()
+        kwargs['member'] = member
+        kwargs['pv0_random_seed'] = int(self.seeds[member])
+        kwargs['logfile'] = os.path.splitext(self.generator.logfile)[0] + f'.member{member:03d}.log'
+        return kwargs
+
+
+    def create_store(self):
+        """Write the metadata and coordinates of the ensemble store, without
+        any data, so that each member can write its own region"""
+
+        gen = self.generator
+        n_time = gen.trajectory_steps + 1
+        chunks = gen.zarr_chunks
+        pv = darray.zeros((n_time, gen.Nz, gen.Nx, gen.Nx),
+                          chunks=tuple(chunks[d] for d in ['time', 'z', 'y', 'x']),
+                          dtype=gen.dtype)
+
+        xds = gen.array_to_xarray(pv)
+        xds = xds.expand_dims(member=np.arange(self.n_members))
+        xds = xds.assign_coords(pv0_random_seed=('member', self.seeds))
+        for key in xds.data_vars:
+            xds[key] = xds[key].chunk({d: chunks[d] for d in xds[key].dims})
+        xds.attrs['n_members'] = self.n_members
+
+        store = zarr.NestedDirectoryStore(path=self.zstore)
+        xds.to_zarr(store=store, compute=False)
@@ -1,8 +1,166 @@
 
+import os
+from functools import lru_cache, partial
+
 import numpy as np
 import xarray as xr
 import scipy.fft as sfft
-import dask.array.fft as dfft
+
+def _bin_shells(arr, index, nbins):
+    """Sum the trailing two axes of arr into the bins given by the integer
+    array index, with one np.bincount over every leading index at once.
+    Entries with index >= nbins are dropped.
+    """
+    batch_shape = arr.shape[:-2]
+    arr = arr.reshape(-1, index.size)
+    keep = index.ravel() < nbins
+    n_batch = arr.shape[0]
+
+    bins = np.arange(n_batch)[:, None] * nbins + index.ravel()[keep][None, :]
+    spec1d = np.bincount(bins.ravel(),
+                         weights=arr[:, keep].ravel(),
+                         minlength=n_batch*nbins)
+    return spec1d.reshape(batch_shape + (nbins,)).astype(arr.dtype)
+
+
+@lru_cache(maxsize=16)
+def spectral_geometry(N, L, H, nsq, f):
+    """Build the grid, wavenumbers, shell map and inversion operators for one
+    configuration. This is cached so that every XSQGTurb instance with the same
+    parameters shares one copy, and changing any of them on an instance simply
+    looks up a different entry. The returned arrays should be treated as read only.
+
+    Args:
+        N (int): number of grid points in x and y
+        L, H (float): domain length and lid height (m)
+        nsq, f (float): Brunt-Vaisala and Coriolis frequencies
+
+    Returns:
+        geometry (dict): with DataArrays x, y, z, kx, ky, kmag, mu, sinh_mu,
+            tanh_mu, H_mu, H_mu_sinh, H_mu_tanh, shell_index, dealias_mask
+    """
+
+    geometry = {}
+    for key, desc in zip(['x', 'y'], ['zonal', 'meridional']):
+        c = np.linspace(0, L, N) / 1e3
+        geometry[key] = xr.DataArray(c,
+                                     coords={key: c},
+                                     dims=(key,),
+                                     attrs={'units': 'km',
+                                            'description': f'{desc} ({key}) coordinate'})
+
+    z = np.array([0, H]) / 1e3
+    geometry['z'] = xr.DataArray(z,
+                                 coords={'z': z},
+                                 dims=('z',),
+                                 attrs={'units':'km',
+                                        'description': 'vertical (z) coordinate'})
+
+    kx = np.abs((N*sfft.fftfreq(N)))[:N//2+1]
+    geometry['kx'] = xr.DataArray(kx,
+                                  coords={'kx': kx},
+                                  dims=('kx',),
+                                  attrs={'units': '',
+                                         'description':'Nondimensional wavenumber in x-direction'})
+    ky = N*sfft.fftfreq(N)
+    geometry['ky'] = xr.DataArray(ky,
+                                  coords={'ky': ky},
+                                  dims=('ky',),
+                                  attrs={'units': '',
+                                         'description':'Nondimensional wavenumber in y-direction'})
+
+    kmag = np.sqrt(geometry['kx']**2 + geometry['ky']**2)
+    geometry['kmag'] = kmag
+    geometry['shell_index'] = kmag.astype(int).transpose('ky', 'kx')
+
+    ktrunc = 2. / 3. * (N // 2)
+    geometry['dealias_mask'] = (np.abs(geometry['kx']) < ktrunc) & (np.abs(geometry['ky']) < ktrunc)
+
+    mu = np.sqrt(kmag) * np.sqrt(nsq) * H / f
+    mu = mu.clip(np.finfo(mu).eps).astype(np.float64)
+    geometry['mu'] = mu
+
+    with np.errstate(over='ignore'):
+        geometry['sinh_mu'] = np.sinh(mu).astype(np.float32)
+    geometry['tanh_mu'] = np.tanh(mu).astype(np.float32)
+    geometry['H_mu'] = H / mu
+
+    # inversion operators combined, with the mean (which carries no KE) zeroed
+    # so that they and the streamfunction fit in single precision
+    with np.errstate(over='ignore'):
+        geometry['H_mu_sinh'] = xr.where(kmag > 0, geometry['H_mu'] / np.sinh(mu), 0.)
+    geometry['H_mu_tanh'] = xr.where(kmag > 0, geometry['H_mu'] / np.tanh(mu), 0.)
+    return geometry
+
+
+@lru_cache(maxsize=None)
+def _ke_shells_numba():
+    """Return the numba kernel for kernel='numba', importing numba on first use
+    so that it is neither required nor imported otherwise
+    """
+    import numba
+
+    @numba.njit(parallel=True, cache=True)
+    def ke_shells(psispec, kmag, index, nbins):
+        """Fused |psi|^2 kmag, mean over z, and shell sum for psispec with
+        shape (batch, z, ky, kx), parallel over batch
+        """
+        n_batch, n_z, n_ky, n_kx = psispec.shape
+        kespec1d = np.zeros((n_batch, nbins), dtype=kmag.dtype)
+        for b in numba.prange(n_batch):
+            for iz in range(n_z):
+                for j in range(n_ky):
+                    for i in range(n_kx):
+                        k = index[j, i]
+                        if k < nbins:
+                            c = psispec[b, iz, j, i]
+                            kespec1d[b, k] += kmag[j, i] * (c.real*c.real + c.imag*c.imag)
+        return kespec1d / n_z
+
+    return ke_shells
+
+
+def _numpy_fft(fft, arr, **kwargs):
+    """Apply a numpy.fft function without promoting single precision input"""
+    out = fft(arr, **kwargs)
+    dtype = np.result_type(arr.dtype, np.complex64) if np.iscomplexobj(out) else np.finfo(arr.dtype).dtype
+    return out.astype(dtype, copy=False)
+
+
+@lru_cache(maxsize=16)
+def background_pv(N, L, H, nsq, f, U, symmetric):
+    """Build the background PV of the equilibrium jet for one configuration,
+    cached like :func:`spectral_geometry`. The returned array should be treated as read only.
+
+    Note:
+        The symmetric jet has the same PV on both boundaries, the asymmetric one
+        has no flow at the surface and a stronger gradient at the lid
+
+    Returns:
+        pvbar (xarray.DataArray): with dims (x, y, z)
+    """
+
+    geometry = spectral_geometry(N, L, H, nsq, f)
+    l = 2 * np.pi / L
+    mubar = l * np.sqrt(nsq) * H / f
+
+    # coordinates are stored in km
+    pvbar = -(mubar*U) / (l * H) * np.cos(l*geometry['y']*1e3)
+
+    if symmetric:
+        pvbar = pvbar * 0.5 * np.cosh(.5*mubar) / np.sinh(0.5*mubar)
+
+    else:
+        pvbar = pvbar / np.sinh(mubar)
+
+    pvbar = pvbar.broadcast_like(geometry['x']).broadcast_like(geometry['z']).transpose('x','y','z')
+
+    if not symmetric:
+        pvbar = pvbar.copy()
+        pvbar[...,-1] = pvbar[...,-1]*np.cosh(mubar)
+
+    return pvbar
+
 
 class XSQGTurb():
 
@@ -18,57 +176,62 @@ class XSQGTurb():
     theta0 = 300
     symmetric = True
 
+    fft_backend = 'scipy'   # 'scipy', 'pyfftw', or 'numpy'
+    threads = int(os.getenv('OMP_NUM_THREADS', os.cpu_count()))   # FFT workers, in-memory input
+    dask_threads = 1        # FFT workers per dask block, dask already runs one block per core
+    kernel = 'numpy'        # 'numpy' or 'numba', for the KE spectrum binning
+
+    spectral_diagnostics = {
+        'ke'            : 'KE Density',
+        'ape'           : 'APE Density',
+        'enstrophy'     : 'Potential Enstrophy Density',
+        'ke_transfer'   : 'KE Transfer',
+        'ke_flux'       : 'KE Flux',
+    }
+
+    @property
+    def geometry(self):
+        """Cached coordinates, wavenumbers and inversion operators for the
+        current (N, L, H, nsq, f), see :func:`spectral_geometry`
+        """
+        return spectral_geometry(self.N, self.L, self.H, self.nsq, self.f)
+
     @property
     def x(self):
         """This is consistent with my generator, but not with SQGturb ... just due
         to linspace vs arange
         """
-        x = np.linspace(0, self.L, self.N)
-        x = x/1e3
-        return xr.DataArray(x,
-                            coords={'x':x},
-                            dims=('x'),
-                            attrs={'units': 'km',
-                                   'description': 'zonal (x) coordinate'})
+        return self.geometry['x']
+
     @property
     def y(self):
-        y = np.linspace(0, self.L, self.N)
-        y = y/1e3
-        return xr.DataArray(y,
-                            coords={'y':y},
-                            dims=('y'),
-                            attrs={'units': 'km',
-                                   'description': 'meridional (y) coordinate'})
+        return self.geometry['y']
+
     @property
     def z(self):
-        z = np.array([0, self.H])
-        z = z/1e3
-        return xr.DataArray(z,
-                            coords={'z':z},
-                            dims=('z'),
-                            attrs={'units':'km',
-                                   'description': 'vertical (z) coordinate'})
+        return self.geometry['z']
 
     @property
     def kx(self):
-        kx = np.abs((self.N*sfft.fftfreq(self.N)))[:self.N//2+1]
-        return xr.DataArray(kx,
-                            coords={'kx': kx},
-                            dims=('kx',),
-                            attrs={'units': '',
-                                   'description':'Nondimensional wavenumber in x-direction'})
+        return self.geometry['kx']
+
     @property
     def ky(self):
-        ky = self.N*sfft.fftfreq(self.N)
-        return xr.DataArray(ky,
-                          coords={'ky': ky},
-                          dims=('ky',),
-                          attrs={'units': '',
-                                 'description':'Nondimensional wavenumber in y-direction'})
+        return self.geometry['ky']
 
     @property
     def kmag(self):
-        return np.sqrt(self.kx**2 + self.ky**2)
+        return self.geometry['kmag']
+
+    @property
+    def shell_index(self):
+        """Integer 1D wavenumber shell that each rfft2 coefficient falls into"""
+        return self.geometry['shell_index']
+
+    @property
+    def dealias_mask(self):
+        """True for the wavenumbers kept by the 2/3 rule"""
+        return self.geometry['dealias_mask']
 
     @property
     def kcutoff(self):
@@ -84,33 +247,62 @@ class XSQGTurb():
 
     @property
     def mu(self):
-        mu = np.sqrt(self.kmag) * np.sqrt(self.nsq) * self.H / self.f
-        mu = mu.clip(np.finfo(mu).eps)
-        return mu.astype(np.float64)
+        return self.geometry['mu']
 
 
     def __init__(self, **kwargs):
         for key, val in kwargs.items():
             setattr(self, key, val)
 
+        self._rfft2, self._irfft2 = self._select_fft(self.threads)
+        self._rfft2_block, self._irfft2_block = self._select_fft(self.dask_threads)
 
-    def calc_pvbar(self):
+        if self.kernel not in ('numpy', 'numba'):
+            raise ValueError(f"XSQGTurb.__init__: kernel must be 'numpy' or 'numba', got {self.kernel}")
+        if self.kernel == 'numba':
+            try:
+                _ke_shells_numba()
+            except ImportError:
+                raise ImportError("XSQGTurb.__init__: kernel='numba' requires numba to be installed")
 
-        pvbar = -(self.mubar*self.U) / (self.l * self.H) * np.cos(self.l*self.y)
 
-        if self.symmetric:
-            pvbar = pvbar * 0.5 * np.cosh(.5*self.mubar) / np.sinh(0.5*self.mubar)
+    @classmethod
+    def from_dataset(cls, xds, **kwargs):
+        """Create an XSQGTurb with the resolution and parameters of a dataset,
+        as written by :meth:`SQGTurbGenerator.dataobj_to_xarray`
 
-        else:
-            pvbar = pvbar / np.sinh(mubar)
+        Note:
+            N is the length of x, and any parameters missing from the attributes
+            keep their defaults, except L which is inferred from the x coordinate (km)
+
+        Args:
+            xds (xarray.Dataset or xarray.DataArray): with coordinate x
+            kwargs: override any parameters
+
+        Returns:
+            xsqg (XSQGTurb): with geometry matching the dataset
+        """
+
+        params = {'N': len(xds['x'])}
+        for key in ['H', 'Lr', 'L', 'nsq', 'f', 'g', 'U', 'theta0']:
+            if key in xds.attrs:
+                params[key] = float(xds.attrs[key])
+
+        if 'L' not in params:
+            params['L'] = float(xds['x'][-1]) * 1e3
 
-        pvbar = pvbar.broadcast_like(self.x).broadcast_like(self.z).transpose('x','y','z')
+        if 'symmetric' in xds.attrs:
+            params['symmetric'] = str(xds.attrs['symmetric']) == 'True'
 
-        if not self.symmetric:
-            pvbar = pvbar.copy()
-            pvbar[...,-1] = pvbar[...,-1]*np.cosh(self.mubar)
+        params.update(kwargs)
+        return cls(**params)
 
-        return pvbar
+
+    def calc_pvbar(self):
+        """Background (equilibrium jet) PV, cached per configuration, see
+        :func:`background_pv`
+        """
+        return background_pv(self.N, self.L, self.H, self.nsq, self.f, self.U, self.symmetric)
 
     def theta2pv(self, arr):
         return arr * self.f * self.theta0 / self.g
@@ -121,63 +313,96 @@ class XSQGTurb():
 
 
     def rfft2(self, arr, **kwargs):
-        """Apply along (x,y) axes
-        """
-        dims = arr.dims
-        axes = tuple(dims.index(x) for x in ('y','x'))
-        rfft2 = dfft.rfft2 if hasattr(arr.data, "chunks") else sfft.rfft2
-        spec = rfft2(arr.data, axes=axes, **kwargs)
-
-        kdims = tuple(x if x not in ('y','x') else "k"+x for x in dims)
-
-        coords = {}
-        for key in kdims:
-            if key in dims:
-                coords[key] = arr[key]
-            else:
-                coords[key] = getattr(self, key)
-
-        spec = xr.DataArray(spec,
-                            coords=coords,
-                            dims=kdims,
-                            attrs={'description': f'rfft2 of {arr.name}'})
+        """Apply along (x,y) axes with the instance's FFT backend, blockwise over
+        any other dimensions if dask backed
+        """
+        kdims = tuple(x if x not in ('y','x') else "k"+x for x in arr.dims)
+        fft = self._rfft2 if arr.chunks is None else self._rfft2_block
+        spec = self._apply_fft(fft, arr,
+                               core_dims=('y', 'x'),
+                               sizes={'ky': self.N, 'kx': self.N//2+1},
+                               dtype=np.result_type(arr.dtype, np.complex64),
+                               **kwargs)
+
+        spec = spec.transpose(*kdims).assign_coords(ky=self.ky, kx=self.kx)
+        spec.attrs = {'description': f'rfft2 of {arr.name}'}
         return spec
 
 
     def irfft2(self, arr, **kwargs):
-        """Apply along (x,y) axes
-        """
-        dims = arr.dims
-        axes = tuple(dims.index(x) for x in ('ky','kx'))
-        irfft2 = dfft.irfft2 if hasattr(arr.data, "chunks") else sfft.irfft2
-        grid_arr = irfft2(arr.data, axes=axes, **kwargs)
-
-        gdims = tuple(x if x not in ('ky','kx') else x.replace('k','') for x in dims)
-
-        coords = {}
-        for key in gdims:
-            if key in dims:
-                coords[key] = arr[key]
-            else:
-                coords[key] = getattr(self, key)
-
-        grid_arr = xr.DataArray(grid_arr,
-                                coords=coords,
-                                dims=gdims,
-                                attrs={'description': f'irfft2 of {arr.name}'})
+        """Apply along (x,y) axes with the instance's FFT backend, blockwise over
+        any other dimensions if dask backed
+        """
+        gdims = tuple(x if x not in ('ky','kx') else x.replace('k','') for x in arr.dims)
+        fft = self._irfft2 if arr.chunks is None else self._irfft2_block
+        grid_arr = self._apply_fft(fft, arr,
+                                   core_dims=('ky', 'kx'),
+                                   sizes={'y': self.N, 'x': self.N},
+                                   dtype=np.finfo(arr.dtype).dtype,
+                                   **kwargs)
+
+        grid_arr = grid_arr.transpose(*gdims).assign_coords(y=self.y, x=self.x)
+        grid_arr.attrs = {'description': f'irfft2 of {arr.name}'}
         return grid_arr
 
 
+    def _apply_fft(self, fft, arr, core_dims, sizes, dtype, **kwargs):
+        if arr.chunks is not None:
+            arr = arr.chunk({d: -1 for d in core_dims})
+
+        return xr.apply_ufunc(
+                fft,
+                arr,
+                kwargs={'axes': (-2, -1), **kwargs},
+                input_core_dims=[list(core_dims)],
+                output_core_dims=[list(sizes.keys())],
+                dask='parallelized',
+                output_dtypes=[dtype],
+                dask_gufunc_kwargs={'output_sizes': sizes})
+
+
+    def _select_fft(self, threads):
+        """Return the (rfft2, irfft2) pair for fft_backend using threads workers,
+        called in __init__ for :attr:`threads` and :attr:`dask_threads`"""
+
+        if self.fft_backend == 'scipy':
+            return (partial(sfft.rfft2, workers=threads),
+                    partial(sfft.irfft2, workers=threads))
+
+        elif self.fft_backend == 'pyfftw':
+            try:
+                from pyfftw.interfaces import cache, numpy_fft
+            except ImportError:
+                raise ImportError("XSQGTurb._select_fft: fft_backend='pyfftw' requires pyfftw to be installed")
+
+            # keep FFTW plans alive between calls, so repeated snapshots reuse them
+            cache.enable()
+            cache.set_keepalive_time(60)
+            return (partial(numpy_fft.rfft2, threads=threads),
+                    partial(numpy_fft.irfft2, threads=threads))
+
+        elif self.fft_backend == 'numpy':
+            return (partial(_numpy_fft, np.fft.rfft2),
+                    partial(_numpy_fft, np.fft.irfft2))
+
+        else:
+            raise ValueError(f"XSQGTurb._select_fft: fft_backend must be 'scipy', 'pyfftw', or 'numpy', got {self.fft_backend}")
+
+
     def invert(self, pvspec):
         """invert (rfft2 of) potential vorticity for streamfunction spectra
+
+        Note:
+            The mean (kx=ky=0) streamfunction is arbitrary and is set to zero
         """
-        sh = np.sinh(self.mu).astype(np.float32)
-        th = np.tanh(self.mu).astype(np.float32)
-        Hmu = self.H / self.mu
+        dtype = np.finfo(pvspec.dtype).dtype
+        Hsh = self.geometry['H_mu_sinh'].astype(dtype)
+        Hth = self.geometry['H_mu_tanh'].astype(dtype)
 
-        psispec0 = Hmu * (pvspec.isel(z=1)/sh - pvspec.isel(z=0)/th)
-        psispec1 = Hmu * (pvspec.isel(z=1)/th - pvspec.isel(z=0)/sh)
-        return xr.concat([psispec0, psispec1], dim='z')
+        psispec0 = pvspec.isel(z=1)*Hsh - pvspec.isel(z=0)*Hth
+        psispec1 = pvspec.isel(z=1)*Hth - pvspec.isel(z=0)*Hsh
+        psispec = xr.concat([psispec0, psispec1], dim='z', coords='minimal', compat='override')
+        return psispec.assign_coords(z=pvspec['z']) if 'z' in pvspec.coords else psispec
 
 
     def derivative(self, arr, dim, dealias=True):
@@ -186,56 +411,287 @@ class XSQGTurb():
         Args:
             arr (array_like): array in grid or spectral space
             dim (str): dimension to take derivative along, either "x" or "y"
-            dealias (bool, optional): use 2/3 rule to dealias (pad/truncate) result
+            dealias (bool, optional): use 2/3 rule to dealias (truncate) result
 
         Returns:
             d_arr (array_like): derivative of array
         """
 
         assert dim in ("x", "y")
-        k = self.kx if dim == "x" else self.ky
         spec = self.rfft2(arr) if "kx" not in arr.dims else arr
+        if dealias:
+            spec = spec.where(self.dealias_mask, 0.)
+
+        k = self.kx if dim == "x" else self.ky
+        k = k.astype(np.finfo(spec.dtype).dtype)
         return self.irfft2(spec * k * 1.j)
 
 
-    def calc_kespec1d(self, theta, dimensional_wavenumbers=True):
-        """Compute 1D KE spectrum
+    def gradient(self, arr, dealias=True, velocity=False):
+        """Compute the x and y derivatives of an array, and optionally the
+        velocity from its inverted streamfunction, with one forward and one
+        inverse FFT for all of them
+
+        Args:
+            arr (xarray.DataArray): array in grid or spectral space, can have any
+                other dimensions, e.g. a stack of snapshots
+            dealias (bool, optional): use 2/3 rule to dealias (truncate) result
+            velocity (bool, optional): if True, treat arr as potential temperature
+                and also return u = -dpsi/dy and v = dpsi/dx, requires dim z
+
+        Returns:
+            xds (xarray.Dataset): with d_dx, d_dy, and optionally u, v, in grid space
         """
-        pv = theta * self.g/self.f/self.theta0
-        pvgrd = pv - self.calc_pvbar()
 
-        pvspec = self.rfft2(pv)
-        psispec = self.invert(pvspec)
-        psispec = psispec / (self.N * np.sqrt(2))
+        spec = self.rfft2(arr) if "kx" not in arr.dims else arr
+        if dealias:
+            spec = spec.where(self.dealias_mask, 0.)
+
+        dtype = np.finfo(spec.dtype).dtype
+        ikx = 1.j * self.kx.astype(dtype)
+        iky = 1.j * self.ky.astype(dtype)
+
+        components = {'d_dx': spec * ikx, 'd_dy': spec * iky}
+        if velocity:
+            psispec = self.invert(spec * self.g/self.f/self.theta0).transpose(*spec.dims)
+            components['u'] = -psispec * iky
+            components['v'] = psispec * ikx
 
-        kespec = self.kmag * (psispec * np.conjugate(psispec)).real
+        spec = xr.concat(list(components.values()), dim='component', coords='minimal', compat='override')
+        xds = self.irfft2(spec.assign_coords(component=list(components.keys())))
+        xds = xds.to_dataset(dim='component')
+        xds.attrs = {'description': f'gradient of {arr.name}'}
+        return xds
+
+
+    def bin_shells(self, spec):
+        """Sum spectral coefficients into 1D wavenumber shells, int(|K|) = 0, 1, ..., N//2
+
+        Args:
+            spec (xarray.DataArray): with dims ("ky", "kx") plus any others,
+                can be dask backed as long as ("ky", "kx") are not chunked
+
+        Returns:
+            spec1d (xarray.DataArray): with "k1d" replacing ("ky", "kx") as
+                the final dimension
+        """
+        nbins = len(self.kx)
+        spec1d = xr.apply_ufunc(
+                _bin_shells,
+                spec,
+                kwargs={'index': self.shell_index.values, 'nbins': nbins},
+                input_core_dims=[['ky', 'kx']],
+                output_core_dims=[['k1d']],
+                dask='parallelized',
+                output_dtypes=[spec.dtype],
+                dask_gufunc_kwargs={'output_sizes': {'k1d': nbins}})
+        return spec1d
+
+
+    def _invert_array(self, pvspec):
+        """Like :meth:`invert`, but for raw arrays with trailing axes (z, ky, kx),
+        preserving single precision
+        """
+        dtype = np.finfo(pvspec.dtype).dtype
+        Hsh, Hth = (self.geometry[key].transpose('ky', 'kx').values.astype(dtype)
+                    for key in ['H_mu_sinh', 'H_mu_tanh'])
 
-        # make 1D version by dropping k,z, create k1d
-        tmp = kespec.isel(kx=0,ky=0,z=0)
-        kespec1d = xr.zeros_like(tmp)
+        return np.stack([
+            pvspec[..., 1, :, :]*Hsh - pvspec[..., 0, :, :]*Hth,
+            pvspec[..., 1, :, :]*Hth - pvspec[..., 0, :, :]*Hsh],
+            axis=-3)
 
-        kmag = self.kmag # compute this once
-        kmax = len(self.kx)
 
-        # wavenumbers
-        k1d = np.arange(kmax)
+    def _k1d(self, dimensional_wavenumbers=True):
+        k1d = np.arange(len(self.kx))
         if dimensional_wavenumbers:
             k1d = k1d / self.L * 2 * np.pi * 1e3
             attrs = {'units': 'km', 'description': '1D wavenumber'}
         else:
             attrs = {'units': '', 'description': 'nondimensional 1D wavenumber'}
 
-        k1d = xr.DataArray(k1d, coords={'k1d':k1d}, dims=('k1d',), attrs=attrs)
-        kespec1d = kespec1d.expand_dims({'k1d': k1d}).copy()
+        return xr.DataArray(k1d, coords={'k1d':k1d}, dims=('k1d',), attrs=attrs)
+
+
+    def kespec1d_array(self, theta, blockwise=False):
+        """Compute 1D KE spectrum of raw arrays, this is the kernel applied
+        blockwise by :meth:`calc_kespec1d`
+
+        Args:
+            theta (np.ndarray): with shape (..., z, y, x)
+            blockwise (bool, optional): if True, use :attr:`dask_threads` FFT workers
+
+        Note:
+            With kernel='numba', the KE, vertical mean and shell binning are
+            fused in one compiled loop that runs in parallel over snapshots
+
+        Returns:
+            kespec1d (np.ndarray): with shape (..., k1d)
+        """
+        # keep single precision input in single precision
+        dtype = np.result_type(theta.dtype, np.float32)
+        kmag = self.kmag.transpose('ky', 'kx').values.astype(dtype)
+
+        rfft2 = self._rfft2_block if blockwise else self._rfft2
+        pv = theta * self.g/self.f/self.theta0
+        pvspec = rfft2(pv, axes=(-2, -1))
+
+        psispec = self._invert_array(pvspec)
+        psispec = psispec / float(self.N * np.sqrt(2))
+
+        if self.kernel == 'numba':
+            batch_shape = psispec.shape[:-3]
+            kespec1d = _ke_shells_numba()(psispec.reshape((-1,) + psispec.shape[-3:]),
+                                        kmag, self.shell_index.values, len(self.kx))
+            return kespec1d.reshape(batch_shape + (len(self.kx),))
+
+        kespec = kmag * (psispec * np.conjugate(psispec)).real
+        return _bin_shells(kespec.mean(axis=-3), self.shell_index.values, len(self.kx))
+
 
-        for ikx in range(self.N//2+1):
-            for iky in range(self.N):
+    def calc_kespec1d(self, theta, dimensional_wavenumbers=True):
+        """Compute 1D KE spectrum
 
-                this_k = int(kmag.isel(kx=ikx, ky=iky))
-                if this_k < kmax:
-                    result = kespec.isel(kx=ikx,ky=iky).mean('z')
-                    kespec1d[{'k1d':this_k}] += xr.where(this_k < kmax, result, 0.)
+        Note:
+            The FFT, inversion, KE and shell binning are applied blockwise over
+            every dimension other than (z, y, x), so dask-backed input stays lazy
+            and is only rechunked to be contiguous in (z, y, x)
+
+        Args:
+            theta (xarray.DataArray): potential temperature with dims (z, y, x)
+                in any order, plus any others
+            dimensional_wavenumbers (bool, optional): if True, k1d in rad/km
 
+        Returns:
+            kespec1d (xarray.DataArray): with dim k1d in place of (z, y, x)
+        """
+        spatial = ['z', 'y', 'x']
+        if theta.chunks is not None:
+            theta = theta.chunk({d: -1 for d in spatial})
+
+        kespec1d = xr.apply_ufunc(
+                self.kespec1d_array,
+                theta,
+                kwargs={'blockwise': theta.chunks is not None},
+                input_core_dims=[spatial],
+                output_core_dims=[['k1d']],
+                dask='parallelized',
+                output_dtypes=[theta.dtype],
+                dask_gufunc_kwargs={'output_sizes': {'k1d': len(self.kx)}})
+
+        k1d = self._k1d(dimensional_wavenumbers)
+        kespec1d = kespec1d.assign_coords(k1d=k1d).transpose('k1d', ...)
 
         kespec1d.name = "KE Density"
         return kespec1d
+
+
+    def spectra_array(self, theta, diagnostics=('ke',), blockwise=False):
+        """Compute 1D spectra per vertical level of raw arrays from a single
+        rfft2 of theta, this is the kernel applied blockwise by :meth:`calc_spectra`
+
+        Args:
+            theta (np.ndarray): with shape (..., z, y, x)
+            diagnostics (tuple of str): any of :attr:`spectral_diagnostics`
+            blockwise (bool, optional): if True, use :attr:`dask_threads` FFT workers
+
+        Returns:
+            spectra (list of np.ndarray): one per diagnostic, in the same order,
+                each with shape (..., z, k1d)
+        """
+        dtype = np.result_type(theta.dtype, np.float32)
+        kmag = self.kmag.transpose('ky', 'kx').values.astype(dtype)
+        index = self.shell_index.values
+        nbins = len(self.kx)
+        scale = float(self.N * np.sqrt(2))
+        rfft2, irfft2 = (self._rfft2_block, self._irfft2_block) if blockwise else (self._rfft2, self._irfft2)
+
+        pv = theta * self.g/self.f/self.theta0
+        pvspec = rfft2(pv, axes=(-2, -1))
+        psispec = self._invert_array(pvspec)
+
+        spectra = {}
+        if 'ke' in diagnostics:
+            spectra['ke'] = kmag * np.abs(psispec / scale)**2
+
+        if 'ape' in diagnostics:
+            spectra['ape'] = self.f**2 / self.nsq * np.abs(pvspec / scale)**2
+
+        if 'enstrophy' in diagnostics:
+            spectra['enstrophy'] = np.abs(pvspec / scale)**2
+
+        if 'ke_transfer' in diagnostics or 'ke_flux' in diagnostics:
+            kx = self.kx.values.astype(dtype)[None, :]
+            ky = self.ky.values.astype(dtype)[:, None]
+            psi_x, psi_y, pv_x, pv_y = irfft2(
+                    1.j * np.stack([kx*psispec, ky*psispec, kx*pvspec, ky*pvspec]),
+                    axes=(-2, -1))
+            jacspec = rfft2(psi_x*pv_y - psi_y*pv_x, axes=(-2, -1))
+            jacspec = jacspec * self.dealias_mask.transpose('ky', 'kx').values
+
+            # rfft2 stores only kx >= 0, so count the columns with a conjugate
+            # partner at -kx twice, such that the transfer sums to zero over k1d
+            half_plane = np.where((kx > 0) & (kx < self.N / 2), 2, 1).astype(dtype)
+            spectra['ke_transfer'] = half_plane * (np.conjugate(psispec) * jacspec).real / scale**2
+
+        spectra = {key: _bin_shells(val, index, nbins) for key, val in spectra.items()}
+        if 'ke_flux' in diagnostics:
+            spectra['ke_flux'] = -np.cumsum(spectra['ke_transfer'], axis=-1)
+
+        return [spectra[key].astype(dtype, copy=False) for key in diagnostics]
+
+
+    def calc_spectra(self, theta, diagnostics=None, dimensional_wavenumbers=True):
+        """Compute a set of 1D spectra per vertical level, all derived from one
+        rfft2 of theta. See :attr:`spectral_diagnostics` for the options, where
+
+            - ke is the same KE density as :meth:`calc_kespec1d`, before averaging over z
+            - ape is the available potential energy density, f^2/N^2 |pv|^2
+            - enstrophy is the potential enstrophy density, |pv|^2
+            - ke_transfer is the nonlinear transfer Re[conj(psi) J(psi, pv)] binned in k1d,
+              with J truncated by the 2/3 rule, so it sums to zero for dealiased input
+            - ke_flux is the flux through each k1d, minus the cumulative sum of ke_transfer
+
+        Args:
+            theta (xarray.DataArray): potential temperature with dims (z, y, x)
+                in any order, plus any others
+            diagnostics (str or tuple of str, optional): which spectra to compute,
+                defaults to all of :attr:`spectral_diagnostics`
+            dimensional_wavenumbers (bool, optional): if True, k1d in rad/km
+
+        Returns:
+            spectra (xarray.Dataset): with one variable per diagnostic, with
+                dims (k1d, z) in place of (z, y, x)
+        """
+        diagnostics = self.spectral_diagnostics if diagnostics is None else diagnostics
+        diagnostics = (diagnostics,) if isinstance(diagnostics, str) else tuple(diagnostics)
+        for key in diagnostics:
+            if key not in self.spectral_diagnostics:
+                raise ValueError(f"XSQGTurb.calc_spectra: unrecognized diagnostic {key}, choose from {self.spectral_diagnostics}")
+
+        spatial = ['z', 'y', 'x']
+        blockwise = theta.chunks is not None
+        if blockwise:
+            theta = theta.chunk({d: -1 for d in spatial})
+
+        def kernel(arr):
+            result = self.spectra_array(arr, diagnostics, blockwise=blockwise)
+            return tuple(result) if len(result) > 1 else result[0]
+
+        n = len(diagnostics)
+        spectra = xr.apply_ufunc(
+                kernel,
+                theta,
+                input_core_dims=[spatial],
+                output_core_dims=[['z', 'k1d']]*n,
+                dask='parallelized',
+                output_dtypes=[theta.dtype]*n,
+                dask_gufunc_kwargs={'output_sizes': {'k1d': len(self.kx)}})
+        spectra = (spectra,) if n == 1 else spectra
+
+        k1d = self._k1d(dimensional_wavenumbers)
+        xds = xr.Dataset()
+        for key, val in zip(diagnostics, spectra):
+            xds[key] = val.assign_coords(k1d=k1d).transpose('k1d', 'z', ...)
+            xds[key].attrs['label'] = self.spectral_diagnostics[key]
+        return xds
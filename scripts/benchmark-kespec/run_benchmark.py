@@ -0,0 +1,90 @@
+"""Benchmark the 1D KE spectrum kernels in snapshots per second
+
+Compares the original xarray double loop over (kx, ky), the NumPy bincount
+kernel, and the numba kernel (if installed), on a batch of random NxNx2
+snapshots, with usage
+
+    python run_benchmark.py [n_snapshots] [N]
+
+The original loop is only timed on a small batch, since its cost is
+dominated by the number of (kx, ky) pairs rather than the number of snapshots.
+"""
+
+import sys
+from time import perf_counter
+
+import numpy as np
+import xarray as xr
+
+sys.path.append("../..")
+from rcgfd import XSQGTurb
+
+
+def legacy_kespec1d(xsqg, theta):
+    """The original implementation of XSQGTurb.calc_kespec1d"""
+
+    pv = theta * xsqg.g/xsqg.f/xsqg.theta0
+    pvspec = xsqg.rfft2(pv)
+    psispec = xsqg.invert(pvspec)
+    psispec = psispec / (xsqg.N * np.sqrt(2))
+
+    kespec = xsqg.kmag * (psispec * np.conjugate(psispec)).real
+
+    tmp = kespec.isel(kx=0,ky=0,z=0)
+    kespec1d = xr.zeros_like(tmp)
+    kmag = xsqg.kmag
+    kmax = len(xsqg.kx)
+    kespec1d = kespec1d.expand_dims({'k1d': np.arange(kmax)}).copy()
+
+    for ikx in range(xsqg.N//2+1):
+        for iky in range(xsqg.N):
+            this_k = int(kmag.isel(kx=ikx, ky=iky))
+            if this_k < kmax:
+                result = kespec.isel(kx=ikx,ky=iky).mean('z')
+                kespec1d[{'k1d':this_k}] += xr.where(this_k < kmax, result, 0.)
+
+    return kespec1d
+
+
+def random_theta(xsqg, n_snapshots, seed=0):
+    rs = np.random.RandomState(seed)
+    theta = rs.normal(scale=5., size=(n_snapshots, 2, xsqg.N, xsqg.N)).astype(np.float32)
+    return xr.DataArray(theta,
+                        coords={'time': np.arange(n_snapshots), 'z': xsqg.z, 'y': xsqg.y, 'x': xsqg.x},
+                        dims=('time', 'z', 'y', 'x'))
+
+
+def snapshots_per_second(func, theta, n_repeat=3):
+    func(theta.isel(time=slice(0, 1)))
+    walltime = []
+    for _ in range(n_repeat):
+        start = perf_counter()
+        func(theta)
+        walltime.append(perf_counter() - start)
+    return len(theta['time']) / min(walltime)
+
+
+if __name__ == "__main__":
+
+    n_snapshots = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    N = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    xsqg = XSQGTurb(N=N)
+    theta = random_theta(xsqg, n_snapshots)
+
+    results = {}
+    results['legacy loop'] = snapshots_per_second(lambda t: legacy_kespec1d(xsqg, t), theta.isel(time=slice(0, 10)), n_repeat=1)
+    results['numpy, xarray wrapper'] = snapshots_per_second(xsqg.calc_kespec1d, theta)
+    results['numpy, raw array'] = snapshots_per_second(lambda t: xsqg.kespec1d_array(t.values), theta)
+
+    try:
+        xnumba = XSQGTurb(N=N, kernel='numba')
+    except ImportError:
+        print("numba not installed, skipping numba kernel")
+    else:
+        results['numba, xarray wrapper'] = snapshots_per_second(xnumba.calc_kespec1d, theta)
+        results['numba, raw array'] = snapshots_per_second(lambda t: xnumba.kespec1d_array(t.values), theta)
+
+    print(f"KE spectrum of {n_snapshots} snapshots, N={xsqg.N}, {xsqg.threads} FFT threads")
+    for key, val in results.items():
+        print(f"{key:<24s}: {val:12.1f} snapshots / second")
@@ -0,0 +1,75 @@
+"""Benchmark opening a validation directory stored as per sample
+results.NNN.zarr stores, comparing the original serial open and xr.concat
+with the concurrent Dataset.open_results, with usage
+
+    python run_benchmark.py [results.zarr path] [n_samples]
+
+If no path is given, synthetic per sample stores are written to a temporary
+directory. Only the time to open and assemble the lazy dataset is measured,
+which is what dominates on a shared filesystem before any computation starts.
+"""
+
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+import xarray as xr
+
+sys.path.append("../..")
+from rcgfd.io import Dataset
+
+
+def legacy_open(fname, n_samples, chunks):
+    """The original fallback in RCDataset.open_single_dataset"""
+    return xr.concat(
+            [xr.open_zarr(fname.replace("results", f"results.{i:03d}"), chunks=chunks) for i in range(n_samples)],
+            dim="sample",
+            coords="minimal")
+
+
+def write_samples(out_dir, n_samples, N=64, n_time=145):
+    fname = os.path.join(out_dir, "results.zarr")
+    rs = np.random.RandomState(0)
+    coords = {"time": np.arange(n_time)*300, "z": [0., 1.], "y": np.arange(N), "x": np.arange(N)}
+    for i in range(n_samples):
+        xds = xr.Dataset({key: xr.DataArray(rs.normal(size=(n_time, 2, N, N)).astype(np.float32),
+                                            coords=coords, dims=("time", "z", "y", "x"))
+                          for key in ["truth", "prediction"]})
+        xds.to_zarr(fname.replace("results", f"results.{i:03d}"), mode="w", consolidated=True)
+    return fname
+
+
+def seconds(func, n_repeat=3):
+    walltime = []
+    for _ in range(n_repeat):
+        start = perf_counter()
+        func()
+        walltime.append(perf_counter() - start)
+    return min(walltime)
+
+
+if __name__ == "__main__":
+
+    fname = sys.argv[1] if len(sys.argv) > 1 else None
+    n_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    tmp_dir = None
+    if fname is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        fname = write_samples(tmp_dir.name, n_samples)
+
+    ds = Dataset(n_samples=n_samples)
+    old = legacy_open(fname, n_samples, ds.chunks)
+    new = ds.open_results(fname)
+    xr.testing.assert_identical(old[["truth", "prediction"]].isel(sample=[0, -1], time=[0, -1]).load(),
+                                new[["truth", "prediction"]].isel(sample=[0, -1], time=[0, -1]).load())
+
+    t_old = seconds(lambda: legacy_open(fname, n_samples, ds.chunks))
+    t_new = seconds(lambda: ds.open_results(fname))
+
+    print(f"Opening {n_samples} per sample stores, {ds.max_workers} threads")
+    print(f"{'serial open, xr.concat':<32s}: {t_old:8.3f} seconds")
+    print(f"{'concurrent open, stacked':<32s}: {t_new:8.3f} seconds")
+    print(f"{'speedup':<32s}: {t_old/t_new:8.1f}x")
@@ -0,0 +1,88 @@
+"""Benchmark read throughput of the original tiled SQG store and the layouts
+written by SQGRechunker, for the access patterns used in this project, with usage
+
+    python run_benchmark.py [zstore]
+
+If no store is given, a small synthetic one with the same chunking as
+the reference store is written to a temporary directory. Throughput is in
+MB / second of data that was actually requested, so reading chunks that are
+mostly discarded shows up as low throughput.
+"""
+
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+import xarray as xr
+
+sys.path.append("../..")
+from rcgfd.rechunk import SQGRechunker
+
+
+def write_source(out_dir, n_time=20_736, N=64):
+    path = os.path.join(out_dir, "sqg.theta.0300dt.064n.02z.02y.02x.zarr")
+    rs = np.random.RandomState(0)
+    xds = xr.Dataset({"theta": (("time", "z", "y", "x"), rs.normal(size=(n_time, 2, N, N)).astype(np.float32))},
+                     coords={"time": (np.arange(n_time)*300).astype("timedelta64[s]"),
+                             "z": [0., 10.], "y": np.arange(N)*1., "x": np.arange(N)*1.},
+                     attrs={"delta_t": 300})
+    xds.chunk({"time": n_time//2, "z": 2, "y": 2, "x": 2}).to_zarr(path)
+    return path
+
+
+def throughput(xda, n_repeat=3):
+    """MB / second to load xda"""
+    walltime = []
+    for _ in range(n_repeat):
+        start = perf_counter()
+        xda.compute()
+        walltime.append(perf_counter() - start)
+    return xda.nbytes / 2**20 / min(walltime)
+
+
+def access_patterns(xda, step, source_step, rs):
+    """The selections of xda for each access pattern, given the store's own
+    subsampling source_step, or None if the store can't serve a pattern"""
+    n_time = len(xda["time"]) * source_step
+    window = n_time // 4
+    start = rs.randint(0, n_time - window) // (step*source_step) * (step*source_step)
+    patterns = {
+        "whole field, 16 random times": xda.isel(time=np.sort(rs.choice(len(xda["time"]), 16, replace=False))),
+        "local patch time series": xda.isel(time=slice(start//source_step, (start+window)//source_step),
+                                            y=slice(0, 2), x=slice(0, 2)),
+    }
+    if step % source_step == 0:
+        stride = step // source_step
+        patterns[f"subsampled, step {step}"] = xda.isel(time=slice(start//source_step, (start+window)//source_step, stride))
+    return patterns
+
+
+if __name__ == "__main__":
+
+    zstore = sys.argv[1] if len(sys.argv) > 1 else None
+    tmp_dir = None
+    if zstore is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        zstore = write_source(tmp_dir.name)
+
+    steps = (1, 4, 16, 48)
+    rechunker = SQGRechunker(zstore=zstore, steps=steps, tmp_dir=tmp_dir.name if tmp_dir else None)
+    paths = {step: rechunker.output_path(step) for step in steps}
+    if not all(os.path.isdir(path) for path in paths.values()):
+        start = perf_counter()
+        rechunker()
+        print(f"Rechunked to {len(steps)} layouts in {perf_counter()-start:.1f} seconds")
+
+    stores = {"original tiles": (zstore, 1)}
+    stores.update({f"field, step {step}": (path, step) for step, path in paths.items()})
+
+    print(f"{'store':<20s} {'access pattern':<32s} {'MB / second':>12s}")
+    for name, (path, source_step) in stores.items():
+        xda = xr.open_zarr(path)["theta"]
+        for step in steps[1:]:
+            rs = np.random.RandomState(step)
+            for pattern, selection in access_patterns(xda, step, source_step, rs).items():
+                if pattern.startswith("subsampled") or step == steps[1]:
+                    print(f"{name:<20s} {pattern:<32s} {throughput(selection):12.1f}")
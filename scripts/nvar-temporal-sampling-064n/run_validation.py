@@ -18,6 +18,7 @@ class NVARTester():
     # defaults, these don't change...
     n_neighbors = 1
     config      = "config-nvar.yaml"
+    presubsampled = False   # if True, read the store already subsampled to delta_t, see ../sqg-064n/subsample.py
 
     @property
     def output_directory(self):
@@ -100,8 +101,11 @@ class NVARTester():
                 }
 
         if self.delta_t != 300:
-            dt_step = self.delta_t // 300
-            new_params["lazydata"]["temporal_subsampling"] = {"start": None, "stop": None, "step": dt_step}
+            if self.presubsampled:
+                new_params["lazydata"]["zstore_path"] = f"../sqg-064n/sqg.theta.{self.delta_t:04d}dt.064n.100kt.02z.02y.02x.zarr"
+            else:
+                dt_step = self.delta_t // 300
+                new_params["lazydata"]["temporal_subsampling"] = {"start": None, "stop": None, "step": dt_step}
 
         if self.mode == "validation":
             new_params["rc"]["store_to_zarr"] = False
@@ -0,0 +1,25 @@
+"""Merge the per sample results.NNN.zarr stores of each validation directory
+into a single results.zarr, see rcgfd.ResultsCompactor"""
+
+import sys
+sys.path.append("../..")
+from rcgfd import RCDataset, ResultsCompactor
+
+
+if __name__ == "__main__":
+
+    rcd = RCDataset(
+        n_sub=[1, 4, 16, 48],
+        cost_terms=[
+            {"nrmse": 1},
+            {"nrmse": 1, "totspectral": 1.e-5},
+            {"nrmse": 1, "totspectral": 1.e-4},
+            {"nrmse": 1, "totspectral": 1.e-3},
+            {"nrmse": 1, "spectral": 0.001},
+            {"nrmse": 1, "spectral": 0.01},
+            {"nrmse": 1, "spectral": 0.1},
+            {"nrmse": 1, "spectral": 1.0},
+            {"nrmse": 1, "spectral": 10.0},
+        ],
+    )
+    ResultsCompactor(dataset=rcd)()
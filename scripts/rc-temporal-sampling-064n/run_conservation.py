@@ -19,6 +19,7 @@ class RCTester():
     n_workers   = 8
     n_overlap   = 1
     n_reservoir = 6_000
+    presubsampled = False   # if True, read the store already subsampled to delta_t, see ../sqg-064n/subsample.py
 
     @property
     def n_nodes(self):
@@ -184,8 +185,11 @@ class RCTester():
                 }
 
         if self.delta_t != 300:
-            dt_step = self.delta_t // 300
-            new_params["lazydata"]["temporal_subsampling"] = {"start": None, "stop": None, "step": dt_step}
+            if self.presubsampled:
+                new_params["lazydata"]["zstore_path"] = f"../sqg-064n/sqg.theta.{self.delta_t:04d}dt.064n.100kt.02z.02y.02x.zarr"
+            else:
+                dt_step = self.delta_t // 300
+                new_params["lazydata"]["temporal_subsampling"] = {"start": None, "stop": None, "step": dt_step}
 
         if "micro" in self.mode:
             new_params["rc"]["store_to_zarr"] = True
@@ -228,7 +232,7 @@ class RCTester():
             client.close()
 
 
-def main(delta_t, cost_terms, RCTools="MapRCTools", n_samples=50, n_macro=10, n_overlap=1, n_reservoir=6_000):
+def main(delta_t, cost_terms, RCTools="MapRCTools", n_samples=50, n_macro=10, n_overlap=1, n_reservoir=6_000, presubsampled=False):
 
     for mode in ["macro-calibration", "micro-calibration", "validation"]:
         n_s = None if "validation" not in mode else n_samples
@@ -240,7 +244,8 @@ def main(delta_t, cost_terms, RCTools="MapRCTools", n_samples=50, n_macro=10, n_
                 n_samples=n_s,
                 n_macro=n_macro,
                 n_overlap=n_overlap,
-                n_reservoir=n_reservoir
+                n_reservoir=n_reservoir,
+                presubsampled=presubsampled,
                 )
         rct()
 
@@ -0,0 +1,13 @@
+"""Compute climatological statistics of the reference trajectory, used to
+normalize the validation metrics, from the whole field layout written by rechunk.py"""
+
+import sys
+sys.path.append("../..")
+from rcgfd import SpectralClimatology
+
+
+if __name__ == "__main__":
+
+    sc = SpectralClimatology(zstore="sqg.theta.0300dt.064n.100kt.02z.02y.02x.field.01step.zarr",
+                             output="sqg.theta.0300dt.064n.100kt.02z.02y.02x.climatology.zarr")
+    sc()
@@ -22,7 +22,8 @@ if __name__ == '__main__':
                                           'z':2,
                                           'y':1,
                                           'x':1},
-                               threads=5)
+                               threads=5,
+                               block_steps=8_640) # 30 days at a time
 
         gen(pickup_zstore=pickup_zstore)
 
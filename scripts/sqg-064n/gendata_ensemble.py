@@ -0,0 +1,27 @@
+import sys
+sys.path.append("../..")
+
+from rcgfd import SQGTurbEnsemble
+
+if __name__ == '__main__':
+
+    Nx = 64
+    n_years = 1
+    n_members = 8
+
+    ens = SQGTurbEnsemble(zstore=f"sqg.ensemble.{n_members:02d}m.{Nx:03d}n.{n_years:03d}years.zarr",
+                          n_members=n_members,
+                          n_workers=n_members,
+                          Nx=Nx,
+                          delta_t=int(1200 / 4),
+                          trajectory_time=n_years*360*24*3600,
+                          logfile=f'stdout.ensemble.{n_years}years.{Nx:03d}n.log',
+                          chunksize={'time':None,
+                                     'z':2,
+                                     'y':Nx,
+                                     'x':Nx},
+                          threads=2,
+                          block_steps=8_640) # 30 days at a time
+
+    rate = ens()
+    print(f"{rate:.1f} member days / wall hour")
@@ -0,0 +1,13 @@
+"""Write whole field layouts of the reference trajectory, every 300 s and
+subsampled to 1200, 4800 and 14400 s, for spectral diagnostics"""
+
+import sys
+sys.path.append("../..")
+from rcgfd import SQGRechunker
+
+
+if __name__ == "__main__":
+
+    rc = SQGRechunker(zstore="sqg.theta.0300dt.064n.100kt.02z.02y.02x.zarr",
+                      steps=(1, 4, 16, 48))
+    rc()
@@ -0,0 +1,16 @@
+"""Write copies of the reference trajectory subsampled to each delta_t used
+in the temporal sampling experiments, with the same chunks, so that runs with
+delta_t != 300 can read them directly, see RCTester.presubsampled"""
+
+import sys
+sys.path.append("../..")
+from rcgfd import SQGRechunker
+
+
+if __name__ == "__main__":
+
+    # 600, 1200, 2400, 4800, 14400 s
+    rc = SQGRechunker(zstore="sqg.theta.0300dt.064n.100kt.02z.02y.02x.zarr",
+                      steps=(2, 4, 8, 16, 48),
+                      match_source_chunks=True)
+    rc()